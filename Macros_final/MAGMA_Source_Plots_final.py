@@ -9,6 +9,7 @@ from scipy.interpolate import interp1d, RectBivariateSpline
 from scipy.integrate import quad,simps
 from mpl_toolkits.mplot3d import Axes3D
 import time
+from magma_tools import nucleus_tables, RadialSampler, sample_batch, event_randoms, deposit, StencilCache, FFTDeposition, grid_tiles
 from ROOT import TColor, TCanvas, TGraph, TGraph2D, gStyle, TStyle, TPad, TH2D, TLegend, TArrow, TLatex, TExec
 import ROOT
 #import gROOT
@@ -19,14 +20,6 @@ import ROOT
 ###############################################################  
 ###############################################################        
 
-#Thickness function. Note that the overall normalization is not needed.
-def thick(x,y,lim,step,R,a):
-    zz=np.arange(0,lim+step,step)
-    def f2p(x,y,z,R,a): #2-parameter fermi distribution for spherical nucleus
-        return 1./(1+np.exp((np.sqrt(x**2+y**2+z**2)-R)/a))
-    fun=f2p(x,y,zz,R,a)
-    return 2.*np.trapz(fun,zz) #use symmetry
-
 #Converts GeV into fm^-1
 conv=1/0.197327
 
@@ -45,7 +38,7 @@ Nc=3
 
 #Define a fine grid to evaluate thickness functions, Qs^2, and the source densities.
 #A grid within [-14fm, 14fm] with step of 0.1fm gives excellent precision.
-#Evaluation is slow but we use it only once.
+#Evaluation is vectorized and we use it only once.
 lim=14 #fm
 step=0.1 #fm
 xx=np.arange(-lim,lim+step,step)
@@ -53,27 +46,22 @@ yy=np.arange(-lim,lim+step,step)
 ll=xx.size
 x,y=np.meshgrid(xx,yy)
 
-#Evaluate thickness functions at the center of nuclei.
-T0_A=thick(0,0,lim,step,R_A,a_A) #fm^-2
-T0_B=thick(0,0,lim,step,R_B,a_B) #fm^-2
-
-#Evaluate density of sources and QS^2.
-#First compute TA and TB.
-T_A=np.zeros((ll,ll))
-T_B=np.zeros((ll,ll))
-for j in range(ll):
-    for k in range(ll):
-        T_A[j,k]=thick(xx[j],yy[k],lim,step,R_A,a_A)
-        T_B[j,k]=thick(xx[j],yy[k],lim,step,R_B,a_B)
+#Radial-profile mode: T, n and Qs^2 only depend on r for spherical nuclei.
+#They are tabulated once on a fine 1D grid in r and evaluated at (x,y) by
+#interpolating in r (see magma_tools.py), which is much cheaper than 2D splines.
+#Set radial=False to use the full 2D tables and RectBivariateSpline.
+radial=True
 
-#To avoid re-computing thickness functions, we interpolate.
-#Probability density for nuclei A and B.
+#T0, T, n, Qs^2 and the average number of sources N in the box [-12, 12]^2.
+#They only depend on (R, a, Q0, m, Nc, lim, step), so after the first run they
+#are loaded from the on-disk cache in magma_cache/ (cache_dir=None to rebuild).
+#For identical nuclei (symmetric systems like Pb-Pb) A and B share one set of tables.
+T0_A,T_A,n_A,Q2_A,N_A=nucleus_tables(R_A,a_A,Q0_A,m,Nc,lim,step,box=12,radial=radial)
+T0_B,T_B,n_B,Q2_B,N_B=nucleus_tables(R_B,a_B,Q0_B,m,Nc,lim,step,box=12,radial=radial)
 
-n_A=RectBivariateSpline(xx,yy,(Nc**2-1)/(32*np.pi)*Q0_A**2*T_A/T0_A*1/np.log(1+Q0_A**2/m**2*T_A/T0_A))
-n_B=RectBivariateSpline(xx,yy,(Nc**2-1)/(32*np.pi)*Q0_B**2*T_B/T0_B*1/np.log(1+Q0_B**2/m**2*T_B/T0_B))
-#Saturation scales ^2.
-Q2_A=RectBivariateSpline(xx,yy,Q0_A**2*T_A/T0_A)
-Q2_B=RectBivariateSpline(xx,yy,Q0_B**2*T_B/T0_B)
+#2D thickness tables for the WS plots.
+T_A=T_A.ev(*np.meshgrid(xx,yy,indexing='ij'))
+T_B=T_B.ev(*np.meshgrid(xx,yy,indexing='ij'))
 
 
 #Define grid where event-by-event profile will be evaluated.
@@ -91,20 +79,53 @@ yy=np.linspace(dim,-dim,size+1)
 xx=(xx[1:]+xx[:-1])/2
 yy=(yy[1:]+yy[:-1])/2
 
-#the grid
-x_grid,y_grid=np.meshgrid(xx,yy)
-
 #Choose size of box in which coords will be generated by the rejection method.
 #A box within -12 to 12 fm is good enough.
 lim=12 #fm
 
-#Average number of sources in each nucleus.
-N_A=n_A.integral(-lim,lim,-lim,lim)
-N_B=n_B.integral(-lim,lim,-lim,lim)
+#Samplers of source coordinates in the same box (radial mode only).
+#Inverse-CDF in r and uniform azimuths, no rejection needed.
+#Identical nuclei share one sampler.
+if radial:
+    sampler_A=RadialSampler(n_A,lim)
+    sampler_B=sampler_A if n_B is n_A else RadialSampler(n_B,lim)
 
 #choose number of events to generate
 nev=int(1)
 
+#Deposition algorithm: 'loop' is the reference per-source loop over the whole
+#grid, 'local' only visits the cells within 1/m of each source, 'scatter' does
+#the same for blocks of sources at once without a Python loop (fastest at
+#size~100), 'stencil' adds precomputed kernel patches (approximate: on
+#rho_A*rho_B e_tot is typically off by ~1% and up to 7% in peripheral events,
+#about as fast as 'scatter' at size~100), 'fft' convolves binned sources with one kernel per
+#Qs^2 class (fine grids and very many sources only, cell errors of a few %),
+#'jit' compiles the 'local' loops with numba (falls back to 'local' without it).
+deposition='local'
+if deposition=='stencil':
+    deposition=StencilCache(1/m,1/max(Q0_A,Q0_B)**2,100.)
+elif deposition=='fft':
+    deposition=FFTDeposition(1/m,1/max(Q0_A,Q0_B)**2,100.)
+
+#the grid (only for the 'loop' reference, two more full grids)
+if deposition=='loop':
+    x_grid,y_grid=np.meshgrid(xx,yy)
+
+#Fine grids (size=1000 and more) are evaluated in tiles of tile x tile cells
+#(the last tiles of a row or column take a leftover single cell, e.g. size=2049).
+#Each tile gets the list of sources reaching it and its own small grids for
+#A and B, and only rho and rho_mod are kept for the whole grid, with the same
+#result as the whole grid at once. tile=size does the whole grid at once.
+tile=256
+
+#Number of events whose sources are generated together (radial mode).
+chunk=1000
+
+#Seed of the run. Event ev uses the random stream (seed, ev), so results do not
+#depend on how events are split among workers, and a single event can be
+#regenerated by running only that ev (e.g. to re-render a SONIC profile).
+seed=12345
+
 #matrix where we store observables, listed below.
 obs=np.zeros((nev,7))
 #impact parameter
@@ -125,11 +146,27 @@ obs=np.zeros((nev,7))
 ev=0
 for ev in range(nev):
 
+    #All random numbers of event ev come from its own stream, made from (seed, ev).
+    if ev%chunk==0:
+        rngs=event_randoms(seed,ev,min(chunk,nev-ev))
+    rng=rngs[ev%chunk]
+
     #Now generate coordinates of the sources.
-    #Number of sources A from Poisson distribution.
-    A_A=np.random.poisson(N_A)
-    #Number of sources B from Poisson distribution.
-    A_B=np.random.poisson(N_B)
+    if radial:
+        #Sources are drawn for a chunk of events at a time and stored as
+        #flat arrays plus per-event offsets.
+        if ev%chunk==0:
+            batch_A=sample_batch(sampler_A,N_A,len(rngs),rngs)
+            batch_B=sample_batch(sampler_B,N_B,len(rngs),rngs)
+        x_A,y_A=batch_A.event(ev%chunk)
+        x_B,y_B=batch_B.event(ev%chunk)
+        A_A=x_A.size
+        A_B=x_B.size
+    else:
+        #Number of sources A from Poisson distribution.
+        A_A=rng.poisson(N_A)
+        #Number of sources B from Poisson distribution.
+        A_B=rng.poisson(N_B)
 
     #Store tot number of sources.
     obs[ev,1]=A_A+A_B
@@ -139,69 +176,71 @@ for ev in range(nev):
 ####     using to a rejection algorithm.                         ####
 ##################################################################### 
 
-    #Generate sources A.
-    x_A=np.zeros(A_A)
-    y_A=np.zeros(A_A)
-    n0_A=n_A.ev(0,0)
-
-    ##Optimized algorithm to generate coordinates.
-    gen=int(10*A_A)    
-    cont=0
-    while cont>=0:
-        loop=cont
-        u=np.random.uniform(-lim,lim,size=gen)
-        v=np.random.uniform(-lim,lim,size=gen)
-        rand=np.random.random(gen,)
-        n_eval=n_A.ev(u,v)
-        n_eval/=(n0_A*rand)
-        coords_ev=np.where(n_eval>1)
-        cont=cont+coords_ev[0].size
-        x_ev=u[coords_ev[0]]
-        y_ev=v[coords_ev[0]]
-        if cont<=A_A:
-            x_A[loop:cont]=x_ev
-            y_A[loop:cont]=y_ev
-        else:
-            mmax=A_A-loop
-            x_A[loop:]=x_ev[0:mmax]
-            y_A[loop:]=y_ev[0:mmax]
-            break
-    
-    #Generate sources B
-    x_B=np.zeros(A_B)
-    y_B=np.zeros(A_B)
-    n0_B=n_B.ev(0,0)
-    
-    ##Optimized algorithm to generate coordinates.
-    gen=int(10*A_B)    
-    cont=0
-    while cont>=0:
-        loop=cont
-        u=np.random.uniform(-lim,lim,size=gen)
-        v=np.random.uniform(-lim,lim,size=gen)
-        rand=np.random.random(gen,)
-        n_eval=n_B.ev(u,v)
-        n_eval/=(n0_B*rand)
-        coords_ev=np.where(n_eval>1)
-        cont=cont+coords_ev[0].size
-        x_ev=u[coords_ev[0]]
-        y_ev=v[coords_ev[0]]
-        if cont<=A_B:
-            x_B[loop:cont]=x_ev
-            y_B[loop:cont]=y_ev
-        else:
-            mmax=A_B-loop
-            x_B[loop:]=x_ev[0:mmax]
-            y_B[loop:]=y_ev[0:mmax]
-            break
-    
+    #In radial mode the coords were drawn above with the inverse-CDF sampler.
+    if not radial:
+        #Generate sources A.
+        x_A=np.zeros(A_A)
+        y_A=np.zeros(A_A)
+        n0_A=n_A.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_A)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_A.ev(u,v)
+            n_eval/=(n0_A*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_A:
+                x_A[loop:cont]=x_ev
+                y_A[loop:cont]=y_ev
+            else:
+                mmax=A_A-loop
+                x_A[loop:]=x_ev[0:mmax]
+                y_A[loop:]=y_ev[0:mmax]
+                break
+
+        #Generate sources B
+        x_B=np.zeros(A_B)
+        y_B=np.zeros(A_B)
+        n0_B=n_B.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_B)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_B.ev(u,v)
+            n_eval/=(n0_B*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_B:
+                x_B[loop:cont]=x_ev
+                y_B[loop:cont]=y_ev
+            else:
+                mmax=A_B-loop
+                x_B[loop:]=x_ev[0:mmax]
+                y_B[loop:]=y_ev[0:mmax]
+                break
+
 ########################################
 #### GENERATE AN IMPACT PARAMETER. #####
 ########################################        
     
 
     #Draw a random b-centrality and then compute b using nucleus-nucleus cross section.
-    c=np.random.uniform(0,1)
+    c=rng.uniform(0,1)
 
     # b=np.sqrt(767*c/np.pi) #767 fm^2 for Pb-Pb collisions.
     
@@ -222,74 +261,105 @@ for ev in range(nev):
 ################################################################
 ################################################################
     
-    #Energy density profiles for A and B.
-    rho_A=np.zeros((size,size))
-    rho_B=np.zeros((size,size))
-    rho_A_mod=np.zeros((size,size))
-    rho_B_mod=np.zeros((size,size))
-
-    #Optimized algorithm to evaluate sources on the grid.
-    #Loop over sources in A.
-    for j in range(A_A):
-        x_Aj=x_A[j]
-        y_Aj=y_A[j]
-        x_loop=(x_grid-x_Aj)
-        y_loop=(y_grid-y_Aj)
-        radius=np.sqrt(x_loop**2+y_loop**2)
-        indic=np.where(radius<1/m) #evaluate only within radius 1/m
-        indic_x=indic[0]
-        indic_y=indic[1]
-        ##########################################################################
-        ######################## now evaluate rho_A ############################## 
-        ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-        rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_Aj-b/2,y_Aj)/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_Aj+b/2,y_Aj)) #fm^-4
-
-        ##########################################################################
-        ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-#        rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])) #fm^-4
-        
-        ##########################################################################
-        ## Revised magma code where it is only dependent on product of sources ##
-        ##########################################################################
-
-        rho_A_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_Aj+b/2,y_Aj)) #fm^-4
-
-    #Optimized algorithm to evaluate sources on the grid.
-    #Loop over sources in B.
-    for j in range(A_B):
-        x_Bj=x_B[j]
-        y_Bj=y_B[j]
-        x_loop=(x_grid-x_B[j])
-        y_loop=(y_grid-y_B[j])
-        radius=np.sqrt(x_loop**2+y_loop**2)
-        indic=np.where(radius<1/m) #evaluate only within radius 1/m
-        indic_x=indic[0]
-        indic_y=indic[1]
-        ##########################################################################
-        ######################## now evaluate rho_B ############################## 
-        ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-        rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_Bj+b/2,y_Bj)/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_Bj-b/2,y_Bj)) #fm^-4
-        ##########################################################################
-        ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-#        rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])) #fm^-4
-    
-        ##########################################################################
-        ## Revised magma code where it is only dependent on product of sources ##
-        ##########################################################################
-
-        rho_B_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_Bj-b/2,y_Bj))
-
-    #Compute total energy density profile.
-    rho = (rho_A + rho_B)/conv #Gev/fm^3
-    rho_mod = rho_A_mod*rho_B_mod/conv #Gev
+    #Qs^2 of both nuclei at all source positions, one vectorized call each
+    #instead of scalar .ev calls inside the loops below.
+    #Be careful with impact parameter shift and coords.
+    Q2A_at_A=Q2_A.ev(x_A+b/2,y_A)
+    Q2B_at_A=Q2_B.ev(x_A-b/2,y_A)
+    Q2A_at_B=Q2_A.ev(x_B+b/2,y_B)
+    Q2B_at_B=Q2_B.ev(x_B-b/2,y_B)
+
+    if deposition=='loop':
+        #Energy density profiles for A and B.
+        rho_A=np.zeros((size,size))
+        rho_B=np.zeros((size,size))
+        rho_A_mod=np.zeros((size,size))
+        rho_B_mod=np.zeros((size,size))
+
+        #Reference algorithm: distances to every cell of the grid for each source.
+        #Optimized algorithm to evaluate sources on the grid.
+        #Loop over sources in A.
+        for j in range(A_A):
+            x_Aj=x_A[j]
+            y_Aj=y_A[j]
+            x_loop=(x_grid-x_Aj)
+            y_loop=(y_grid-y_Aj)
+            radius=np.sqrt(x_loop**2+y_loop**2)
+            indic=np.where(radius<1/m) #evaluate only within radius 1/m
+            indic_x=indic[0]
+            indic_y=indic[1]
+            ##########################################################################
+            ######################## now evaluate rho_A ############################## 
+            ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+            rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2B_at_A[j]/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2A_at_A[j]) #fm^-4
+
+            ##########################################################################
+            ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+#            rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])) #fm^-4
+
+            ##########################################################################
+            ## Revised magma code where it is only dependent on product of sources ##
+            ##########################################################################
+
+            rho_A_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2A_at_A[j]) #fm^-4
+
+        #Optimized algorithm to evaluate sources on the grid.
+        #Loop over sources in B.
+        for j in range(A_B):
+            x_Bj=x_B[j]
+            y_Bj=y_B[j]
+            x_loop=(x_grid-x_B[j])
+            y_loop=(y_grid-y_B[j])
+            radius=np.sqrt(x_loop**2+y_loop**2)
+            indic=np.where(radius<1/m) #evaluate only within radius 1/m
+            indic_x=indic[0]
+            indic_y=indic[1]
+            ##########################################################################
+            ######################## now evaluate rho_B ############################## 
+            ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+            rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2A_at_B[j]/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2B_at_B[j]) #fm^-4
+            ##########################################################################
+            ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+#            rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])) #fm^-4
+
+            ##########################################################################
+            ## Revised magma code where it is only dependent on product of sources ##
+            ##########################################################################
+
+            rho_B_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2B_at_B[j])
+
+        #Compute total energy density profile.
+        rho = (rho_A + rho_B)/conv #Gev/fm^3
+        rho_mod = rho_A_mod*rho_B_mod/conv #Gev
+    else:
+        #Amplitudes of each source for the original and the modified
+        #prescription. The kernel is the same, so the sources of A (B) are
+        #deposited once on a stack of two grids [original, modified].
+        amp_A=np.array([8/g**2/Nc*Q2B_at_A,np.full(A_A,8/g**2/Nc)])
+        amp_B=np.array([8/g**2/Nc*Q2A_at_B,np.full(A_B,8/g**2/Nc)])
+
+        rho=np.zeros((size,size))
+        rho_mod=np.zeros((size,size))
+        for rows,cols,(j_A,j_B) in grid_tiles(xx,yy,[(x_A,y_A),(x_B,y_B)],1/m,tile):
+            #Energy density profiles for A and B on the tile.
+            #Each source only touches the cells around its 1/m footprint.
+            #Same result as the loop above (see magma_tools.py for the backends).
+            rho_A=np.zeros((2,yy[rows].size,xx[cols].size))
+            rho_B=np.zeros((2,yy[rows].size,xx[cols].size))
+            deposit(rho_A,xx[cols],yy[rows],x_A[j_A],y_A[j_A],amp_A[:,j_A],1/Q2A_at_A[j_A],1/m,deposition) #fm^-4
+            deposit(rho_B,xx[cols],yy[rows],x_B[j_B],y_B[j_B],amp_B[:,j_B],1/Q2B_at_B[j_B],1/m,deposition) #fm^-4
+
+            #Compute total energy density profile on the tile.
+            rho[rows,cols] = (rho_A[0] + rho_B[0])/conv #Gev/fm^3
+            rho_mod[rows,cols] = rho_A[1]*rho_B[1]/conv #Gev
 
 ##################################################
 ############### graphic check ####################
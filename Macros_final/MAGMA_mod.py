@@ -9,6 +9,8 @@ from scipy.interpolate import interp1d, RectBivariateSpline
 from scipy.integrate import quad,simps
 from mpl_toolkits.mplot3d import Axes3D
 import time
+import tracemalloc
+from magma_tools import nucleus_tables, RadialSampler, sample_batch, event_randoms, deposit, StencilCache, FFTDeposition, sample_centrality, footprints_overlap, overlap_support, overlap_window, EventContext, PrecisionReport
 from ROOT import TColor, TCanvas, TGraph, TGraph2D, gStyle, TStyle, TPad, TH2D, TLegend, TArrow, TLatex, TH1D, TLine, TMultiGraph, gPad
 import ROOT
 
@@ -22,14 +24,6 @@ import ROOT
 
 time_start = time.time()
 
-#Thickness function. Note that the overall normalization is not needed.
-def thick(x,y,lim,step,R,a):
-    zz=np.arange(0,lim+step,step)
-    def f2p(x,y,z,R,a): #2-parameter fermi distribution for spherical nucleus
-        return 1./(1+np.exp((np.sqrt(x**2+y**2+z**2)-R)/a))
-    fun=f2p(x,y,zz,R,a)
-    return 2.*np.trapz(fun,zz) #use symmetry
-
 #Converts GeV into fm^-1
 conv=1/0.197327
 
@@ -48,7 +42,7 @@ Nc=3
 
 #Define a fine grid to evaluate thickness functions, Qs^2, and the source densities.
 #A grid within [-14fm, 14fm] with step of 0.1fm gives excellent precision.
-#Evaluation is slow but we use it only once.
+#Evaluation is vectorized and we use it only once.
 lim=14 #fm
 step=0.1 #fm
 size =100
@@ -57,40 +51,97 @@ yy=np.arange(-lim,lim+step,step)
 ll=xx.size
 x,y=np.meshgrid(xx,yy)
 
-#Evaluate thickness functions at the center of nuclei.
-T0_A=thick(0,0,lim,step,R_A,a_A) #fm^-2
-T0_B=thick(0,0,lim,step,R_B,a_B) #fm^-2
-
-#Evaluate density of sources and QS^2.
-#First compute TA and TB.
-T_A=np.zeros((ll,ll))
-T_B=np.zeros((ll,ll))
-for j in range(ll):
-    for k in range(ll):
-        T_A[j,k]=thick(xx[j],yy[k],lim,step,R_A,a_A)
-        T_B[j,k]=thick(xx[j],yy[k],lim,step,R_B,a_B)
-#To avoid re-computing thickness functions, we interpolate.
-#Probability density for nuclei A and B.
-
-n_A=RectBivariateSpline(xx,yy,(Nc**2-1)/(32*np.pi)*Q0_A**2*T_A/T0_A*1/np.log(1+Q0_A**2/m**2*T_A/T0_A))
-n_B=RectBivariateSpline(xx,yy,(Nc**2-1)/(32*np.pi)*Q0_B**2*T_B/T0_B*1/np.log(1+Q0_B**2/m**2*T_B/T0_B))
-#Saturation scales ^2.
-Q2_A=RectBivariateSpline(xx,yy,Q0_A**2*T_A/T0_A)
-Q2_B=RectBivariateSpline(xx,yy,Q0_B**2*T_B/T0_B)
+#Radial-profile mode: T, n and Qs^2 only depend on r for spherical nuclei.
+#They are tabulated once on a fine 1D grid in r and evaluated at (x,y) by
+#interpolating in r (see magma_tools.py), which is much cheaper than 2D splines.
+#Set radial=False to use the full 2D tables and RectBivariateSpline.
+radial=True
+
+#T0, T, n, Qs^2 and the average number of sources N in the box [-12, 12]^2.
+#They only depend on (R, a, Q0, m, Nc, lim, step), so after the first run they
+#are loaded from the on-disk cache in magma_cache/ (cache_dir=None to rebuild).
+#For identical nuclei (symmetric systems like Pb-Pb) A and B share one set of tables.
+T0_A,T_A,n_A,Q2_A,N_A=nucleus_tables(R_A,a_A,Q0_A,m,Nc,lim,step,box=12,radial=radial)
+T0_B,T_B,n_B,Q2_B,N_B=nucleus_tables(R_B,a_B,Q0_B,m,Nc,lim,step,box=12,radial=radial)
 
 #Choose size of box in which coords will be generated by the rejection method.
 #A box within -12 to 12 fm is good enough.
 lim=12 #fm
 
-#Average number of sources in each nucleus.
-N_A=n_A.integral(-lim,lim,-lim,lim)
-N_B=n_B.integral(-lim,lim,-lim,lim)
+#Samplers of source coordinates in the same box (radial mode only).
+#Inverse-CDF in r and uniform azimuths, no rejection needed.
+#Identical nuclei share one sampler.
+if radial:
+    sampler_A=RadialSampler(n_A,lim)
+    sampler_B=sampler_A if n_B is n_A else RadialSampler(n_B,lim)
 
 #choose number of events to generate
 nev=int(1000000)
 
+#Deposition algorithm: 'loop' is the reference per-source loop over the whole
+#grid, 'local' only visits the cells within 1/m of each source, 'scatter' does
+#the same for blocks of sources at once without a Python loop (fastest at
+#size~100), 'stencil' adds precomputed kernel patches (approximate: on
+#rho_A*rho_B e_tot is typically off by ~1% and up to 7% in peripheral events,
+#about as fast as 'scatter' at size~100), 'fft' convolves binned sources with one kernel per
+#Qs^2 class (fine grids and very many sources only, cell errors of a few %),
+#'jit' compiles the 'local' loops with numba (falls back to 'local' without it).
+deposition='local'
+if deposition=='stencil':
+    deposition=StencilCache(1/m,1/max(Q0_A,Q0_B)**2,100.)
+elif deposition=='fft':
+    deposition=FFTDeposition(1/m,1/max(Q0_A,Q0_B)**2,100.)
+
+#Drop the sources that cannot contribute to rho_A_mod*rho_B_mod (the
+#number is stored in obs[:,13]).
+prune=True
+
+#Crop the event grid of each event to the cells where rho_mod can be
+#non-zero (the overlap of the footprints of A and B), at the same cell size.
+#The observables are those of the full grid up to rounding.
+crop=True
+
+#Observables: 'numpy' algebra of 2D grids, 'buffered' the same sums as
+#row sums and products of 1D arrays with one scratch grid (same results
+#within rounding), or 'jit' compiled loops without temporary arrays (numba,
+#falls back to 'numpy' without it), or 'polar' from the polar moments below.
+moments='polar'
+
+#With moments='polar': eccentricities eps_n and event-plane angles psi_n (as
+#in e_psi_code.C) of the harmonics, with r^n ('rn') or r^2 ('r2') radial
+#weights, kept in eps_psi and written as (psi_n, eps_n) histograms with the
+#other outputs. E2 and E3 are taken from the same pass (2 and 3 must then be
+#in harmonics; 'r2' changes the weight of E3).
+harmonics=(2,3,4,5,6)
+moment_weight='rn'
+
+#Precision of the grids: 'float32' deposits the densities and makes the
+#products of the observables in single precision (sums stay in float64),
+#which halves the memory traffic. The first n_check events are also
+#computed in float64, and the deviations of e_tot, rms, eps_2 and eps_3 are
+#printed at the end to validate the run.
+precision='float64'
+n_check=100
+
+#Number of events whose sources are generated together (radial mode).
+chunk=1000
+
+#Seed of the run. Event ev uses the random stream (seed, ev), so results do not
+#depend on how events are split among workers, and a single event can be
+#regenerated by running only that ev (e.g. to re-render a SONIC profile).
+seed=12345
+
+#Range of b-centrality to generate, and power>1 to oversample its central side.
+#(0, 1, 1) is the usual min-bias run where every event has weight 1.
+#For studies of central events only, e.g. the 0-1% class for SONIC, use
+#c_max of a few % so that no event outside the range could enter the class.
+#Event weights are carried through the centrality and cumulant analysis.
+c_min,c_max,c_power=0.,1.,1.
+
 #matrix where we store observables, listed below.
-obs=np.zeros((nev,12))
+obs=np.zeros((nev,14))
+#|eps_n| and psi_n for each harmonic (moments='polar').
+eps_psi=np.zeros((nev,len(harmonics),2))
 
 #Event number
 #impact parameter
@@ -104,6 +155,8 @@ obs=np.zeros((nev,12))
 #abs value of epsilon_3
 #epsilon_2
 #epsilon_3
+#event weight from the b-centrality sampling (1 for min-bias)
+#number of sources pruned before the deposition (see below)
 
 ##############################
 ##############################
@@ -111,14 +164,53 @@ obs=np.zeros((nev,12))
 ##############################
 ##############################
 
+#Number of grid cells evaluated over all events.
+n_cells=0
+
+#Define grid where event-by-event profile will be evaluated.
+#Should be able to resolve structures of size 1/Qs ~ 0.2 fm.
+#A 100*100 square from [-9, 9] fm seems to be good enough for all systems.
+#The grid coordinates are made once, and the event context keeps the grids
+#of each event (densities, scratch of the observables) as buffers that are
+#cleared in place, so the event loop does not allocate grids (see
+#ctx.allocations at the end). trace_allocations=True also measures every
+#allocation of the event loop with tracemalloc (much slower) and prints the
+#peak per event, which is how grids made outside the context show up.
+trace_allocations=False
+dim=14 #fm , the grid stretches from [-dim, +dim]
+ctx=EventContext(dim,size,np.float32 if precision=='float32' else np.float64)
+area=ctx.area #fm^2
+if precision=='float32':
+    ctx64=EventContext(dim,size)
+    report=PrecisionReport()
+
+if trace_allocations:
+    tracemalloc.start()
 ev=0
 for ev in range(nev):
+    ctx.new_event()
     obs[ev,0] = ev
+    #All random numbers of event ev come from its own stream, made from (seed, ev).
+    if ev%chunk==0:
+        rngs=event_randoms(seed,ev,min(chunk,nev-ev))
+    rng=rngs[ev%chunk]
+
     #Now generate coordinates of the sources.
-    #Number of sources A from Poisson distribution.
-    A_A=np.random.poisson(N_A)
-    #Number of sources B from Poisson distribution.
-    A_B=np.random.poisson(N_B)
+    if radial:
+        #Sources are drawn for a chunk of events at a time and stored as
+        #flat arrays plus per-event offsets.
+        if ev%chunk==0:
+            batch_A=sample_batch(sampler_A,N_A,len(rngs),rngs)
+            batch_B=sample_batch(sampler_B,N_B,len(rngs),rngs)
+        x_A,y_A=batch_A.event(ev%chunk)
+        x_B,y_B=batch_B.event(ev%chunk)
+        A_A=x_A.size
+        A_B=x_B.size
+    else:
+        #Number of sources A from Poisson distribution.
+        A_A=rng.poisson(N_A)
+        #Number of sources B from Poisson distribution.
+        A_B=rng.poisson(N_B)
 
     #Store tot number of sources.
     obs[ev,2]=A_A+A_B
@@ -128,68 +220,72 @@ for ev in range(nev):
 ####     using to a rejection algorithm.                         ####
 ##################################################################### 
 
-    #Generate sources A.
-    x_A=np.zeros(A_A)
-    y_A=np.zeros(A_A)
-    n0_A=n_A.ev(0,0)
-
-    ##Optimized algorithm to generate coordinates.
-    gen=int(10*A_A)    
-    cont=0
-    while cont>=0:
-        loop=cont
-        u=np.random.uniform(-lim,lim,size=gen)
-        v=np.random.uniform(-lim,lim,size=gen)
-        rand=np.random.random(gen,)
-        n_eval=n_A.ev(u,v)
-        n_eval/=(n0_A*rand)
-        coords_ev=np.where(n_eval>1)
-        cont=cont+coords_ev[0].size
-        x_ev=u[coords_ev[0]]
-        y_ev=v[coords_ev[0]]
-        if cont<=A_A:
-            x_A[loop:cont]=x_ev
-            y_A[loop:cont]=y_ev
-        else:
-            mmax=A_A-loop
-            x_A[loop:]=x_ev[0:mmax]
-            y_A[loop:]=y_ev[0:mmax]
-            break
-    
-    #Generate sources B
-    x_B=np.zeros(A_B)
-    y_B=np.zeros(A_B)
-    n0_B=n_B.ev(0,0)
-    
-    ##Optimized algorithm to generate coordinates.
-    gen=int(10*A_B)    
-    cont=0
-    while cont>=0:
-        loop=cont
-        u=np.random.uniform(-lim,lim,size=gen)
-        v=np.random.uniform(-lim,lim,size=gen)
-        rand=np.random.random(gen,)
-        n_eval=n_B.ev(u,v)
-        n_eval/=(n0_B*rand)
-        coords_ev=np.where(n_eval>1)
-        cont=cont+coords_ev[0].size
-        x_ev=u[coords_ev[0]]
-        y_ev=v[coords_ev[0]]
-        if cont<=A_B:
-            x_B[loop:cont]=x_ev
-            y_B[loop:cont]=y_ev
-        else:
-            mmax=A_B-loop
-            x_B[loop:]=x_ev[0:mmax]
-            y_B[loop:]=y_ev[0:mmax]
-            break
-    
+    #In radial mode the coords were drawn above with the inverse-CDF sampler.
+    if not radial:
+        #Generate sources A.
+        x_A=np.zeros(A_A)
+        y_A=np.zeros(A_A)
+        n0_A=n_A.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_A)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_A.ev(u,v)
+            n_eval/=(n0_A*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_A:
+                x_A[loop:cont]=x_ev
+                y_A[loop:cont]=y_ev
+            else:
+                mmax=A_A-loop
+                x_A[loop:]=x_ev[0:mmax]
+                y_A[loop:]=y_ev[0:mmax]
+                break
+
+        #Generate sources B
+        x_B=np.zeros(A_B)
+        y_B=np.zeros(A_B)
+        n0_B=n_B.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_B)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_B.ev(u,v)
+            n_eval/=(n0_B*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_B:
+                x_B[loop:cont]=x_ev
+                y_B[loop:cont]=y_ev
+            else:
+                mmax=A_B-loop
+                x_B[loop:]=x_ev[0:mmax]
+                y_B[loop:]=y_ev[0:mmax]
+                break
+
 ########################################
 #### GENERATE AN IMPACT PARAMETER. #####
 ########################################        
     
     #Draw a random b-centrality and then compute b using nucleus-nucleus cross section.
-    c=np.random.uniform(0,1)
+    #Only c in [c_min, c_max] is generated, and the event weight w corrects for it.
+    c,w=sample_centrality(rng,c_min,c_max,c_power)
+    obs[ev,12]=w
 
     b=np.sqrt(767*c/np.pi) #767 fm^2 for Pb-Pb collisions.
     
@@ -202,7 +298,25 @@ for ev in range(nev):
     #Shift all sources according to impact parameter.
     x_A=x_A-b/2
     x_B=x_B+b/2
- 
+
+    #In A x B the energy density is exactly zero if no footprint (radius 1/m)
+    #of A overlaps one of B. Skip the deposition for such events and store
+    #zeros as observables, so they land in the lowest energy bin without NaNs.
+    if not footprints_overlap(x_A,y_A,x_B,y_B,1/m):
+        obs[ev,4:12]=0
+        obs[ev,13]=A_A+A_B
+        continue
+
+    #Likewise a source of A farther than 2/m from every source of B only
+    #deposits where rho_B_mod=0, and does not change rho_mod. Such sources
+    #are dropped before the deposition, the observables stay the same.
+    if prune:
+        keep_A,keep_B=overlap_support(x_A,y_A,x_B,y_B,1/m)
+        x_A,y_A=x_A[keep_A],y_A[keep_A]
+        x_B,y_B=x_B[keep_B],y_B[keep_B]
+        obs[ev,13]=A_A+A_B-x_A.size-x_B.size
+        A_A=x_A.size
+        A_B=x_B.size
 
 ################################################################    
 ################################################################
@@ -213,95 +327,103 @@ for ev in range(nev):
 
     #########################################
 
-    #Define grid where event-by-event profile will be evaluated.
-    #Should be able to resolve structures of size 1/Qs ~ 0.2 fm.
-    #A 100*100 square from [-9, 9] fm seems to be good enough for all systems.
-
-    dim=14 #fm , the grid stretches from [-dim, +dim]
-    grid_step=2*dim/size #fm
-    area=grid_step**2 #fm^2
+    #Event grid, the same for all events.
+    xx,yy,x_grid,y_grid=ctx.xx,ctx.yy,ctx.x_grid,ctx.y_grid
 
-    #grid coordinates
-    xx=np.linspace(-dim,dim,size+1)
-    yy=np.linspace(dim,-dim,size+1)
-
-    xx=(xx[1:]+xx[:-1])/2
-    yy=(yy[1:]+yy[:-1])/2
-
-    #the grid
-    x_grid,y_grid=np.meshgrid(xx,yy)
+    #Only the part of the grid around the overlap of A and B.
+    if crop:
+        rows,cols=overlap_window(xx,yy,x_A,y_A,x_B,y_B,1/m)
+        xx,yy=xx[cols],yy[rows]
+        x_grid,y_grid=x_grid[rows,cols],y_grid[rows,cols]
+    n_cells+=xx.size*yy.size
 
     ###########################################
 
+    #Qs^2 of both nuclei at all source positions, one vectorized call each
+    #instead of scalar .ev calls inside the loops below.
+    #Be careful with impact parameter shift and coords.
+    Q2A_at_A=Q2_A.ev(x_A+b/2,y_A)
+    Q2B_at_A=Q2_B.ev(x_A-b/2,y_A)
+    Q2A_at_B=Q2_A.ev(x_B+b/2,y_B)
+    Q2B_at_B=Q2_B.ev(x_B-b/2,y_B)
+
     #Energy density profiles for A and B.
 
     # rho_A=np.zeros((size,size))
     # rho_B=np.zeros((size,size))
-    rho_A_mod=np.zeros((size,size))
-    rho_B_mod=np.zeros((size,size))
-
-    #Optimized algorithm to evaluate sources on the grid.
-    #Loop over sources in A.
-    for j in range(A_A):
-        x_Aj=x_A[j]
-        y_Aj=y_A[j]
-        x_loop=(x_grid-x_Aj)
-        y_loop=(y_grid-y_Aj)
-        radius=np.sqrt(x_loop**2+y_loop**2)
-        indic=np.where(radius<1/m) #evaluate only within radius 1/m
-        indic_x=indic[0]
-        indic_y=indic[1]
-        ##########################################################################
-        ######################## now evaluate rho_A ############################## 
-        ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-        # rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_Aj-b/2,y_Aj)/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_Aj+b/2,y_Aj)) #fm^-4
-
-        ##########################################################################
-        ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-#        rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])) #fm^-4
-        
-        ##########################################################################
-        ## Revised magma code where it is only dependent on product of sources ##
-        ##########################################################################
-
-        rho_A_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_Aj+b/2,y_Aj)) #fm^-4
-
-    #Optimized algorithm to evaluate sources on the grid.
-    #Loop over sources in B.
-    for j in range(A_B):
-        x_Bj=x_B[j]
-        y_Bj=y_B[j]
-        x_loop=(x_grid-x_B[j])
-        y_loop=(y_grid-y_B[j])
-        radius=np.sqrt(x_loop**2+y_loop**2)
-        indic=np.where(radius<1/m) #evaluate only within radius 1/m
-        indic_x=indic[0]
-        indic_y=indic[1]
-        ##########################################################################
-        ######################## now evaluate rho_B ############################## 
-        ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-        # rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_Bj+b/2,y_Bj)/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_Bj-b/2,y_Bj)) #fm^-4
-        ##########################################################################
-        ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
-        ##########################################################################
-        #Be careful with impact parameter shift and coords.
-#        rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])) #fm^-4
-    
-        ##########################################################################
-        ## Revised magma code where it is only dependent on product of sources ##
-        ##########################################################################
-
-        rho_B_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_Bj-b/2,y_Bj))
+    rho_A_mod=ctx.zeros('rho_A_mod',(yy.size,xx.size))
+    rho_B_mod=ctx.zeros('rho_B_mod',(yy.size,xx.size))
+
+    if deposition=='loop':
+        #Reference algorithm: distances to every cell of the grid for each source.
+        #Optimized algorithm to evaluate sources on the grid.
+        #Loop over sources in A.
+        for j in range(A_A):
+            x_Aj=x_A[j]
+            y_Aj=y_A[j]
+            x_loop=(x_grid-x_Aj)
+            y_loop=(y_grid-y_Aj)
+            radius=np.sqrt(x_loop**2+y_loop**2)
+            indic=np.where(radius<1/m) #evaluate only within radius 1/m
+            indic_x=indic[0]
+            indic_y=indic[1]
+            ##########################################################################
+            ######################## now evaluate rho_A ############################## 
+            ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+            # rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2B_at_A[j]/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2A_at_A[j]) #fm^-4
+
+            ##########################################################################
+            ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+#            rho_A[indic_x,indic_y]+=8/g**2/Nc*Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])) #fm^-4
+
+            ##########################################################################
+            ## Revised magma code where it is only dependent on product of sources ##
+            ##########################################################################
+
+            rho_A_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2A_at_A[j]) #fm^-4
+
+        #Optimized algorithm to evaluate sources on the grid.
+        #Loop over sources in B.
+        for j in range(A_B):
+            x_Bj=x_B[j]
+            y_Bj=y_B[j]
+            x_loop=(x_grid-x_B[j])
+            y_loop=(y_grid-y_B[j])
+            radius=np.sqrt(x_loop**2+y_loop**2)
+            indic=np.where(radius<1/m) #evaluate only within radius 1/m
+            indic_x=indic[0]
+            indic_y=indic[1]
+            ##########################################################################
+            ######################## now evaluate rho_B ############################## 
+            ## ORIGINAL MAGMA PRESCRIPTION: overall QsA^2 and QsB^2 for each source ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+            # rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2A_at_B[j]/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2B_at_B[j]) #fm^-4
+            ##########################################################################
+            ## MODIFICATION OF GG: let QsA^2 and QsB^2 vary over the source profile ##
+            ##########################################################################
+            #Be careful with impact parameter shift and coords.
+#            rho_B[indic_x,indic_y]+=8/g**2/Nc*Q2_A.ev(x_grid[indic_x,indic_y]+b/2,y_grid[indic_x,indic_y])/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2_B.ev(x_grid[indic_x,indic_y]-b/2,y_grid[indic_x,indic_y])) #fm^-4
+
+            ##########################################################################
+            ## Revised magma code where it is only dependent on product of sources ##
+            ##########################################################################
+
+            rho_B_mod[indic_x,indic_y]+=8/g**2/Nc/(x_loop[indic_x,indic_y]**2+y_loop[indic_x,indic_y]**2+1/Q2B_at_B[j])
+    else:
+        #Each source only touches the cells around its 1/m footprint.
+        #Same result as the loop above (see magma_tools.py for the backends).
+        deposit(rho_A_mod,xx,yy,x_A,y_A,8/g**2/Nc,1/Q2A_at_A,1/m,deposition) #fm^-4
+        deposit(rho_B_mod,xx,yy,x_B,y_B,8/g**2/Nc,1/Q2B_at_B,1/m,deposition) #fm^-4
 
     #Compute total energy density profile.
     # rho = (rho_A + rho_B)/conv #Gev/fm^3
-    rho_mod = rho_A_mod*rho_B_mod/conv #Gev
+    rho_mod = np.multiply(rho_A_mod,rho_B_mod,out=ctx.buffer('rho_mod',rho_A_mod.shape))
+    rho_mod /= conv #Gev
 
     # obs[ev,3] = rho
 
@@ -309,7 +431,7 @@ for ev in range(nev):
     #and will take up too much memory while running the program.
 
     # if np.sum(rho_mod) >= 10000:
-    #     rho_dict[ev] = rho_mod
+    #     rho_dict[ev] = rho_mod.copy() #rho_mod is reused by the next event
 
     # else: 
     #     rho_dict[ev] = 0
@@ -321,38 +443,45 @@ for ev in range(nev):
 
     #Total energy.
 
-    #If impact parameter too large, the rho may = 0
-
-    e_tot=np.sum(rho_mod)
+    #Total energy, recentering correction, rms radius, eccentricity and
+    #triangularity from one call (see magma_tools.py).
+    if moments=='polar':
+        polar=ctx.polar_moments(rho_mod,xx,yy,harmonics,moment_weight)
+        eps_psi[ev,:,0]=np.abs(polar.eps)
+        eps_psi[ev,:,1]=polar.psi
+        e_tot,center_x,center_y,rms,E2,E3=polar.grid_moments()
+    else:
+        e_tot,center_x,center_y,rms,E2,E3=ctx.moments(rho_mod,xx,yy,moments)
+
+    #The same event in float64 for the precision report.
+    if precision=='float32' and ev<n_check:
+        rho_A64=deposit(ctx64.zeros('rho_A_mod',(yy.size,xx.size)),xx,yy,x_A,y_A,8/g**2/Nc,1/Q2A_at_A,1/m,deposition) #fm^-4
+        rho_B64=deposit(ctx64.zeros('rho_B_mod',(yy.size,xx.size)),xx,yy,x_B,y_B,8/g**2/Nc,1/Q2B_at_B,1/m,deposition) #fm^-4
+        rho_mod64=np.multiply(rho_A64,rho_B64,out=ctx64.buffer('rho_mod',rho_A64.shape))
+        rho_mod64/=conv #Gev
+        if moments=='polar':
+            ref=ctx64.polar_moments(rho_mod64,xx,yy,harmonics,moment_weight).grid_moments()
+        else:
+            ref=ctx64.moments(rho_mod64,xx,yy,moments)
+        report.add((e_tot,center_x,center_y,rms,E2,E3),ref)
+
+    #If impact parameter too large, the rho may = 0.
+    #Then store zeros as for the events skipped above.
+    if e_tot==0:
+        obs[ev,4:12]=0
+        continue
     obs[ev,4]=e_tot
     obs[ev,5]=e_tot*area
-    
-    #Recentering correction 
-    center_x=np.sum(rho_mod*x_grid)/e_tot
-    center_y=np.sum(rho_mod*y_grid)/e_tot
-    x_cen=x_grid-center_x
-    y_cen=y_grid-center_y
-    
-    #RMS radius, eccentricity, triangularity
-    z=x_cen+y_cen*1.j
-    r2=x_cen**2+y_cen**2
-    r3=r2**(3/2.)
-
-    #evaluate epsilon_2
-    e2_num=rho_mod*z**2
-    e2_den=rho_mod*r2
-    E2=-np.sum(e2_num)/np.sum(e2_den)
+
+    #epsilon_2
     obs[ev,7]=np.real(E2)
     obs[ev,8]=np.imag(E2)
 
-    #evaluate epsilon_3
-    e3_num=rho_mod*z**3
-    e3_den=rho_mod*r3
-    E3=-np.sum(e3_num)/np.sum(e3_den)
+    #epsilon_3
     obs[ev,9]=np.abs(E3)
 
-    #evaluate rms radius
-    obs[ev,6]=np.sqrt(np.sum(e2_den)/e_tot)
+    #rms radius
+    obs[ev,6]=rms
 
     #Evaluate e_tot, e2, e3
 
@@ -380,18 +509,26 @@ n_bin = 100
 #Fill histogram with j bins (j = 10,000 should be sufficient)
 hist_e_tot = TH1D("hist","",10000, 0, e_max)
 
-for e_tot in obs[:,4]:
-    hist_e_tot.Fill(e_tot)
+for e_tot, w in zip(obs[:,4], obs[:,12]):
+    hist_e_tot.Fill(e_tot, w)
 
 #The fraction of events above bin i defines the centrality bins and where we put energy lines on the plot
 
 e_line_array = np.zeros(n_bin + 1)
 centrality_array = np.zeros(n_bin + 1)
 
-total_integral = hist_e_tot.Integral(1, 10000)
+#Events outside the generated b-centrality range (weight nev - sum of weights)
+#are split in proportion to the min-bias fractions c_min and 1-c_max: those
+#with c<c_min are taken to be above the generated ones in energy and those
+#with c>c_max below (choose c_min, c_max accordingly). The weight below is
+#added below every bin, the weight above only to the total (classes more
+#central than c_min then keep an edge of 0 and stay empty).
+missing_out = nev - np.sum(obs[:,12])
+missing = missing_out*(1-c_max)/(1-c_max+c_min) if c_max-c_min<1 else 0.
+total_integral = hist_e_tot.Integral(1, 10000) + missing_out
 for i in range(101):
     for j in range(1,10000):
-        frac_ev = hist_e_tot.Integral(1, j) / total_integral
+        frac_ev = (hist_e_tot.Integral(1, j) + missing) / total_integral
         if frac_ev >= (1 - i/100):
             centrality_array[i] = hist_e_tot.GetBinCenter(j)
             e_line_array[i] = hist_e_tot.GetBinCenter(j)
@@ -423,6 +560,7 @@ for i in range(0, n_bin -1):
     e2_2_list = []
     e2_4_list = []
     e3_2_list = []
+    w_list = []
 
     ev_ctr = 0
 
@@ -435,6 +573,7 @@ for i in range(0, n_bin -1):
             e2_2_list.append(obs[ev_ctr , 10])
             e2_4_list.append(obs[ev_ctr , 10])
             e3_2_list.append(obs[ev_ctr , 11])
+            w_list.append(obs[ev_ctr , 12])
             ev_ctr += 1
         else:
 
@@ -444,6 +583,10 @@ for i in range(0, n_bin -1):
     e2_2_array = np.array(e2_2_list)
     n2_2 = len(e2_2_list)
 
+    #Event weights. All the means below are weighted means.
+    w_array = np.array(w_list)
+    sum_w = np.sum(w_array)
+
     #if there are no e_tots per bin, that's ok. Make it equivalent to zero. Else calculate as normal
     if n2_2 == 0:
         e2_2 = 0
@@ -451,7 +594,7 @@ for i in range(0, n_bin -1):
         #e_2{2} is the rms of the e_2 array
 
         #dot product of e_2 array^2
-        mean_e2_sqrd = np.dot(e2_2_array, e2_2_array)/n2_2
+        mean_e2_sqrd = np.dot(w_array*e2_2_array, e2_2_array)/sum_w
         
         e2_2 = np.sqrt(mean_e2_sqrd)
 
@@ -471,10 +614,10 @@ for i in range(0, n_bin -1):
             x_4th_list.append(element_4th)
 
         x_4th_array = np.array(x_4th_list)
-        e2_4th = np.sum(x_4th_array)
+        e2_4th = np.sum(w_array*x_4th_array)
 
-        mean_e2_sqr = np.dot(e2_4_array, e2_4_array)/n2_4
-        mean_e2_4th = e2_4th/n2_4
+        mean_e2_sqr = np.dot(w_array*e2_4_array, e2_4_array)/sum_w
+        mean_e2_4th = e2_4th/sum_w
 
         if 2*(mean_e2_sqr)**2 < mean_e2_4th:
             e2_4 = 0
@@ -491,7 +634,7 @@ for i in range(0, n_bin -1):
         e3_2 = 0
     else:
 
-        mean_e3_sqrd = np.dot(e3_2_array, e3_2_array)/n3_2
+        mean_e3_sqrd = np.dot(w_array*e3_2_array, e3_2_array)/sum_w
         e3_2 = np.sqrt(mean_e3_sqrd)
 
     #Calculation of e2{2}/e3{2}
@@ -550,6 +693,15 @@ gr_e3_over_e2_ratio_mod.Write('e3_over_e2_MAGMA')
 
 hist_e_tot.Write('Energy_Distribution_MAGMA_mod')
 
+#(psi_n, eps_n) of every event for each harmonic, with the event weights.
+if moments=='polar':
+    for j,n in enumerate(harmonics):
+        hist_eps_psi = TH2D("eps_psi_%d"%n,"",100, 0, 2*np.pi/n, 100, 0, 1)
+        for (eps_n, psi_n), e_tot, w in zip(eps_psi[:,j], obs[:,4], obs[:,12]):
+            if e_tot > 0:
+                hist_eps_psi.Fill(psi_n, eps_n, w)
+        hist_eps_psi.Write('eps_psi_%d_MAGMA_mod'%n)
+
 
 # ##############################################################################
 # ########     TH2D Plots for SONIC Hydrodynamic calculations            #######
@@ -603,3 +755,12 @@ hist_e_tot.Write('Energy_Distribution_MAGMA_mod')
 
 #End of program
 print('it took', (time.time() - time_start), 's for ', nev, '  Pb-Pb events')
+print('grid buffers allocated:', ctx.allocations, ', in the last event:', ctx.event_allocations)
+if trace_allocations:
+    ctx.end_event()
+    print('allocated during an event: %.0f kB on average, at most %.0f kB (a grid is %.0f kB);'%(ctx.mean_event_peak()/1e3, ctx.max_event_peak/1e3, ctx.size**2*np.dtype(ctx.dtype).itemsize/1e3),
+          'events allocating a whole grid or more:', ctx.grid_events, 'of', nev)
+if precision=='float32':
+    print(report)
+print('fraction of sources pruned before the deposition:', np.sum(obs[:,13])/np.sum(obs[:,2]))
+print('mean number of grid cells per event:', n_cells/nev)
@@ -0,0 +1,542 @@
+from __future__ import division
+import numpy as np
+from array import array
+import matplotlib.pyplot as plt
+from matplotlib import gridspec
+from matplotlib.gridspec import GridSpec
+import scipy.special as sp
+from scipy.interpolate import interp1d, RectBivariateSpline
+from scipy.integrate import quad,simps
+from mpl_toolkits.mplot3d import Axes3D
+import time
+from magma_tools import nucleus_tables, RadialSampler, sample_batch, event_randoms, StencilCache, FFTDeposition, grid_moments, sample_centrality, event_grids, prescription, GridFieldCache
+from ROOT import TColor, TCanvas, TGraph, TGraph2D, gStyle, TStyle, TPad, TH2D, TLegend, TArrow, TLatex, TH1D, TLine, TMultiGraph, gPad
+import ROOT
+
+###############################################################  
+###############################################################
+####     SYSTEM SETUP. DOES NOT CHANGE EVENT-BY-EVENT.    #####
+###############################################################  
+###############################################################        
+
+#Current time to evaluate how long it takes to run events
+
+time_start = time.time()
+
+#Converts GeV into fm^-1
+conv=1/0.197327
+
+#Choose colliding nuclei. Set radius and diffusiveness.
+a_A, R_A = 0.55, 6.62 #fm
+a_B, R_B = 0.55, 6.62 #fm
+
+#Choose m and the saturation scale at the center of the nuclei.
+m = 0.14*conv #fm^-1
+Q0_A = 1.24*conv #fm^-1
+Q0_B = 1.24*conv #fm^-1
+
+#QCD coupling and number of colors.
+g=np.sqrt(np.pi)
+Nc=3
+
+#Define a fine grid to evaluate thickness functions, Qs^2, and the source densities.
+#A grid within [-14fm, 14fm] with step of 0.1fm gives excellent precision.
+#Evaluation is vectorized and we use it only once.
+lim=14 #fm
+step=0.1 #fm
+size =100
+xx=np.arange(-lim,lim+step,step)
+yy=np.arange(-lim,lim+step,step)
+ll=xx.size
+x,y=np.meshgrid(xx,yy)
+
+#Radial-profile mode: T, n and Qs^2 only depend on r for spherical nuclei.
+#They are tabulated once on a fine 1D grid in r and evaluated at (x,y) by
+#interpolating in r (see magma_tools.py), which is much cheaper than 2D splines.
+#Set radial=False to use the full 2D tables and RectBivariateSpline.
+radial=True
+
+#T0, T, n, Qs^2 and the average number of sources N in the box [-12, 12]^2.
+#They only depend on (R, a, Q0, m, Nc, lim, step), so after the first run they
+#are loaded from the on-disk cache in magma_cache/ (cache_dir=None to rebuild).
+#For identical nuclei (symmetric systems like Pb-Pb) A and B share one set of tables.
+T0_A,T_A,n_A,Q2_A,N_A=nucleus_tables(R_A,a_A,Q0_A,m,Nc,lim,step,box=12,radial=radial)
+T0_B,T_B,n_B,Q2_B,N_B=nucleus_tables(R_B,a_B,Q0_B,m,Nc,lim,step,box=12,radial=radial)
+
+#Choose size of box in which coords will be generated by the rejection method.
+#A box within -12 to 12 fm is good enough.
+lim=12 #fm
+
+#Samplers of source coordinates in the same box (radial mode only).
+#Inverse-CDF in r and uniform azimuths, no rejection needed.
+#Identical nuclei share one sampler.
+if radial:
+    sampler_A=RadialSampler(n_A,lim)
+    sampler_B=sampler_A if n_B is n_A else RadialSampler(n_B,lim)
+
+#choose number of events to generate
+nev=int(1000000)
+
+#Prescriptions computed from the same events, see magma_tools.py:
+#  'orig'      original MAGMA (A x B_WS + A_WS x B with Qs^2 at the sources),
+#  'product'   modified MAGMA (A x B),
+#  'sum', 'geometric' (sqrt(A x B), TRENTo-type), 'mean' with parameter p,
+#  'cross_ws'  A x B_WS + A_WS x B with the Qs^2 profiles on the grid,
+#  'gg'        original MAGMA with Qs^2 taken at each cell (MODIFICATION OF GG).
+#The sources of A and B are sampled once and deposited once per event. Each
+#prescription combines the same per-nucleus grids, and its outputs are
+#written with its own tag ('MAGMA' and 'MAGMA_mod' are those of MAGMA_orig.py
+#and MAGMA_mod.py). One run gives correlated events for the comparison.
+prescriptions=[prescription('orig'),prescription('product')]
+#prescriptions=[prescription('orig'),prescription('product'),prescription('geometric'),prescription('mean',p=0.5),prescription('cross_ws'),prescription('gg')]
+
+#Grids needed by the prescriptions.
+needs=set(n for pr in prescriptions for n in pr.needs)
+
+#Qs^2 and WS thickness of A and B on the event grid are kept for the last
+#impact parameter, so runs at fixed b evaluate them once (min-bias runs
+#evaluate them every event and hold only one grid of each).
+fields=GridFieldCache(Q2_A,Q2_B,T_A,T_B)
+
+#Deposition algorithm: 'local' only visits the cells within 1/m of each source, 'scatter' does
+#the same for blocks of sources at once without a Python loop (fastest at
+#size~100), 'stencil' adds precomputed kernel patches (approximate: on
+#rho_A*rho_B e_tot is typically off by ~1% and up to 7% in peripheral events,
+#about as fast as 'scatter' at size~100), 'fft' convolves binned sources with one kernel per
+#Qs^2 class (fine grids and very many sources only, cell errors of a few %),
+#'jit' compiles the 'local' loops with numba (falls back to 'local' without it).
+deposition='local'
+if deposition=='stencil':
+    deposition=StencilCache(1/m,1/max(Q0_A,Q0_B)**2,100.)
+elif deposition=='fft':
+    deposition=FFTDeposition(1/m,1/max(Q0_A,Q0_B)**2,100.)
+
+#Observables: 'numpy' algebra of 2D grids, or 'jit' compiled loops without
+#temporary arrays (numba, falls back to 'numpy' without it).
+moments='numpy'
+
+#Number of events whose sources are generated together (radial mode).
+chunk=1000
+
+#Seed of the run. Event ev uses the random stream (seed, ev), so results do not
+#depend on how events are split among workers, and a single event can be
+#regenerated by running only that ev (e.g. to re-render a SONIC profile).
+seed=12345
+
+#Range of b-centrality to generate, and power>1 to oversample its central side.
+#(0, 1, 1) is the usual min-bias run where every event has weight 1.
+#For studies of central events only, e.g. the 0-1% class for SONIC, use
+#c_max of a few % so that no event outside the range could enter the class.
+#Event weights are carried through the centrality and cumulant analysis.
+c_min,c_max,c_power=0.,1.,1.
+
+#matrix where we store observables, listed below, one per prescription.
+#Columns 0-2 and 12 are the same for all of them.
+obs=np.zeros((len(prescriptions),nev,13))
+
+#Event number
+#impact parameter
+#tot number of sources
+#rho
+#total energy
+#tot energy*area
+#rms radius: sqrt(<r^2>)
+#real part of epsilon_2
+#imag part of epsilon_2
+#abs value of epsilon_3
+#epsilon_2
+#epsilon_3
+#event weight from the b-centrality sampling (1 for min-bias)
+
+##############################
+##############################
+### start loop over events ###
+##############################
+##############################
+
+
+ev=0
+for ev in range(nev):
+    obs[:,ev,0] = ev
+    #All random numbers of event ev come from its own stream, made from (seed, ev).
+    if ev%chunk==0:
+        rngs=event_randoms(seed,ev,min(chunk,nev-ev))
+    rng=rngs[ev%chunk]
+
+    #Now generate coordinates of the sources.
+    if radial:
+        #Sources are drawn for a chunk of events at a time and stored as
+        #flat arrays plus per-event offsets.
+        if ev%chunk==0:
+            batch_A=sample_batch(sampler_A,N_A,len(rngs),rngs)
+            batch_B=sample_batch(sampler_B,N_B,len(rngs),rngs)
+        x_A,y_A=batch_A.event(ev%chunk)
+        x_B,y_B=batch_B.event(ev%chunk)
+        A_A=x_A.size
+        A_B=x_B.size
+    else:
+        #Number of sources A from Poisson distribution.
+        A_A=rng.poisson(N_A)
+        #Number of sources B from Poisson distribution.
+        A_B=rng.poisson(N_B)
+
+    #Store tot number of sources.
+    obs[:,ev,2]=A_A+A_B
+
+#####################################################################
+####     GENERATE COORDS for sources in nucleus A and nucleus B  ####
+####     using to a rejection algorithm.                         ####
+##################################################################### 
+
+    #In radial mode the coords were drawn above with the inverse-CDF sampler.
+    if not radial:
+        #Generate sources A.
+        x_A=np.zeros(A_A)
+        y_A=np.zeros(A_A)
+        n0_A=n_A.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_A)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_A.ev(u,v)
+            n_eval/=(n0_A*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_A:
+                x_A[loop:cont]=x_ev
+                y_A[loop:cont]=y_ev
+            else:
+                mmax=A_A-loop
+                x_A[loop:]=x_ev[0:mmax]
+                y_A[loop:]=y_ev[0:mmax]
+                break
+
+        #Generate sources B
+        x_B=np.zeros(A_B)
+        y_B=np.zeros(A_B)
+        n0_B=n_B.ev(0,0)
+
+        ##Optimized algorithm to generate coordinates.
+        gen=int(10*A_B)    
+        cont=0
+        while cont>=0:
+            loop=cont
+            u=rng.uniform(-lim,lim,size=gen)
+            v=rng.uniform(-lim,lim,size=gen)
+            rand=rng.random(gen,)
+            n_eval=n_B.ev(u,v)
+            n_eval/=(n0_B*rand)
+            coords_ev=np.where(n_eval>1)
+            cont=cont+coords_ev[0].size
+            x_ev=u[coords_ev[0]]
+            y_ev=v[coords_ev[0]]
+            if cont<=A_B:
+                x_B[loop:cont]=x_ev
+                y_B[loop:cont]=y_ev
+            else:
+                mmax=A_B-loop
+                x_B[loop:]=x_ev[0:mmax]
+                y_B[loop:]=y_ev[0:mmax]
+                break
+
+########################################
+#### GENERATE AN IMPACT PARAMETER. #####
+########################################        
+    
+    #Draw a random b-centrality and then compute b using nucleus-nucleus cross section.
+    #Only c in [c_min, c_max] is generated, and the event weight w corrects for it.
+    c,w=sample_centrality(rng,c_min,c_max,c_power)
+    obs[:,ev,12]=w
+
+    b=np.sqrt(767*c/np.pi) #767 fm^2 for Pb-Pb collisions.
+    
+    #Or fix the impact parameter.
+    #b = 0.1
+
+    #Store impact parameter.
+    obs[:,ev,1]=b
+
+    #Shift all sources according to impact parameter.
+    x_A=x_A-b/2
+    x_B=x_B+b/2
+
+################################################################    
+################################################################
+########     COMPUTE energy density in the event.     ##########
+#####  (this step takes >95% of the computation time)    #######
+################################################################
+################################################################
+
+    #########################################
+
+    #Define grid where event-by-event profile will be evaluated.
+    #Should be able to resolve structures of size 1/Qs ~ 0.2 fm.
+    #A 100*100 square from [-9, 9] fm seems to be good enough for all systems.
+
+    dim=14 #fm , the grid stretches from [-dim, +dim]
+    grid_step=2*dim/size #fm
+    area=grid_step**2 #fm^2
+
+    #grid coordinates
+    xx=np.linspace(-dim,dim,size+1)
+    yy=np.linspace(dim,-dim,size+1)
+
+    xx=(xx[1:]+xx[:-1])/2
+    yy=(yy[1:]+yy[:-1])/2
+
+    ###########################################
+
+    #Per-nucleus grids of the event: the deposited sources of A and B and,
+    #if a prescription needs them, Qs^2 of A and B on the grid.
+    grids=event_grids(needs,xx,yy,x_A,y_A,x_B,y_B,b,Q2_A,Q2_B,8/g**2/Nc,1/m,deposition,fields) #fm^-4
+
+###############################################################################
+####     CALCULATE "OBSERVABLES" of every prescription.                   #####
+###############################################################################
+
+    for o,pr in zip(obs,prescriptions):
+        rho=pr.combine(grids)/conv
+
+        #Total energy, recentering correction, rms radius, eccentricity and
+        #triangularity from one call (see magma_tools.py).
+        e_tot,center_x,center_y,rms,E2,E3=grid_moments(rho,xx,yy,moments)
+
+        #If impact parameter too large, the rho may = 0 (A x B without
+        #overlap). Then store zeros, so the event lands in the lowest bin.
+        if e_tot==0:
+            o[ev,4:12]=0
+            continue
+        o[ev,4]=e_tot
+        o[ev,5]=e_tot*area
+
+        #epsilon_2
+        o[ev,7]=np.real(E2)
+        o[ev,8]=np.imag(E2)
+
+        #epsilon_3
+        o[ev,9]=np.abs(E3)
+
+        #rms radius
+        o[ev,6]=rms
+
+        o[ev,10]=np.abs(E2)
+        o[ev,11]=np.abs(E3)
+
+###################
+####End of loop####
+###################
+
+###########################################################################################
+########     Same analysis as MAGMA_orig.py and MAGMA_mod.py for every prescription #######
+###########################################################################################
+
+for tag,obs_p in zip([pr.tag for pr in prescriptions],obs):
+
+    ###########################################################################################
+    ########     Calculate centrality bins by creating a histogram of total energies.   #######
+    ###########################################################################################
+
+    #Sort and define array of total energies to put into histogram.
+    e_max = np.max(obs_p[:,4])
+    e_tot_array = np.sort(obs_p[:,4])
+
+    #Define number of centrality bins
+    n_bin = 100
+
+    #Fill histogram with j bins (j = 10,000 should be sufficient)
+    hist_e_tot = TH1D("hist_" + tag,"",10000, 0, e_max)
+
+    for e_tot, w in zip(obs_p[:,4], obs_p[:,12]):
+        hist_e_tot.Fill(e_tot, w)
+
+    #The fraction of events above bin i defines the centrality bins and where we put energy lines on the plot
+
+    e_line_array = np.zeros(n_bin + 1)
+    centrality_array = np.zeros(n_bin + 1)
+
+    #Events outside the generated b-centrality range (weight nev - sum of weights)
+    #are split in proportion to the min-bias fractions c_min and 1-c_max: those
+    #with c<c_min are taken to be above the generated ones in energy and those
+    #with c>c_max below (choose c_min, c_max accordingly). The weight below is
+    #added below every bin, the weight above only to the total (classes more
+    #central than c_min then keep an edge of 0 and stay empty).
+    missing_out = nev - np.sum(obs_p[:,12])
+    missing = missing_out*(1-c_max)/(1-c_max+c_min) if c_max-c_min<1 else 0.
+    total_integral = hist_e_tot.Integral(1, 10000) + missing_out
+    for i in range(101):
+        for j in range(1,10000):
+            frac_ev = (hist_e_tot.Integral(1, j) + missing) / total_integral
+            if frac_ev >= (1 - i/100):
+                centrality_array[i] = hist_e_tot.GetBinCenter(j)
+                e_line_array[i] = hist_e_tot.GetBinCenter(j)
+                break
+
+    ##############################################################################
+    ########     Calculate v_n fluctuations and ratios per centrality bin  #######
+    ##############################################################################
+
+    #Goes through each total energy for all events (each event has a total energy).
+    #Assigns energies to centrality bins, ie from 0-1% centrality if there are 100 bins.
+    #Calculate v_n fluctuations and ratios per bin.
+
+    #Initialiing coordinates of centralities and moments as lists.
+
+    i = 0
+    centrality_list = []
+    e2_2_list_for_coords = []
+    e2_4_list_for_coords = []
+    e3_2_list_for_coords = []
+    ratio_e2_over_e3_list = []
+    ratio_e3_over_e2_list = []
+
+    for i in range(0, n_bin -1):
+
+        #Inside the bin we try to only find the events that fit in that bin and create a list per bin.
+        #Moments are e2{2}, e2{4}, and e3{2}
+
+        e2_2_list = []
+        e2_4_list = []
+        e3_2_list = []
+        w_list = []
+
+        ev_ctr = 0
+
+        #Creating an array of e2s and e3s in each bin
+
+        for e_tot in obs_p[:,4]:
+
+            if centrality_array[i] >= e_tot >= centrality_array[i+1]:
+
+                e2_2_list.append(obs_p[ev_ctr , 10])
+                e2_4_list.append(obs_p[ev_ctr , 10])
+                e3_2_list.append(obs_p[ev_ctr , 11])
+                w_list.append(obs_p[ev_ctr , 12])
+                ev_ctr += 1
+            else:
+
+                ev_ctr += 1
+
+        #Calculating v_2{2} based on e_2_array
+        e2_2_array = np.array(e2_2_list)
+        n2_2 = len(e2_2_list)
+
+        #Event weights. All the means below are weighted means.
+        w_array = np.array(w_list)
+        sum_w = np.sum(w_array)
+
+        #if there are no e_tots per bin, that's ok. Make it equivalent to zero. Else calculate as normal
+        if n2_2 == 0:
+            e2_2 = 0
+        else:
+            #e_2{2} is the rms of the e_2 array
+
+            #dot product of e_2 array^2
+            mean_e2_sqrd = np.dot(w_array*e2_2_array, e2_2_array)/sum_w
+        
+            e2_2 = np.sqrt(mean_e2_sqrd)
+
+        #Calculating v_2{4} based on e_2_array. 
+        e2_4_array = np.array(e2_4_list)
+
+        n2_4 = len(e2_4_array)
+
+        if n2_4 == 0:
+            e2_4 = 0
+
+        else:
+            x_4th_list = []
+
+            for element in e2_4_array:
+                element_4th = element**4
+                x_4th_list.append(element_4th)
+
+            x_4th_array = np.array(x_4th_list)
+            e2_4th = np.sum(w_array*x_4th_array)
+
+            mean_e2_sqr = np.dot(w_array*e2_4_array, e2_4_array)/sum_w
+            mean_e2_4th = e2_4th/sum_w
+
+            if 2*(mean_e2_sqr)**2 < mean_e2_4th:
+                e2_4 = 0
+
+            else:
+                e2_4 = (2*(mean_e2_sqrd)**2 - mean_e2_4th)**(1/4)
+
+        #Calculating e_3{2} based on e_3_array.
+
+        e3_2_array = np.array(e3_2_list)
+        n3_2 = len(e3_2_list)   
+
+        if n3_2 ==0:
+            e3_2 = 0
+        else:
+
+            mean_e3_sqrd = np.dot(w_array*e3_2_array, e3_2_array)/sum_w
+            e3_2 = np.sqrt(mean_e3_sqrd)
+
+        #Calculation of e2{2}/e3{2}
+        if e2_2 == 0 or e3_2 == 0:
+            ratio_e2_over_e3 = 0
+        else:
+            ratio_e2_over_e3 = e2_2/e3_2
+
+        #Calculation of e2{2}/e3{2}
+        if e2_2 == 0 or e3_2 == 0:
+            ratio_e3_over_e2 = 0
+        else:
+            ratio_e3_over_e2 = e3_2/e2_2
+
+        #Append centrality coordinates and e_n{n} fluctuation coordinates to make ROOT TGraphs.
+
+        centrality_list.append(i+0.5)
+        e2_2_list_for_coords.append(e2_2)
+        e2_4_list_for_coords.append(e2_4)
+        e3_2_list_for_coords.append(e3_2)
+        ratio_e2_over_e3_list.append(ratio_e2_over_e3)
+        ratio_e3_over_e2_list.append(ratio_e3_over_e2)
+
+    ##############################################################################
+    ########     Outputting coordinates as ROOT Files for plots            #######
+    ##############################################################################
+
+    #Convert from lists of coordinates to arrays
+
+    centrality_coord = np.array(centrality_list)
+    e2_2_coord = np.array(e2_2_list_for_coords)
+    e2_4_coord = np.array(e2_4_list_for_coords)
+    e3_2_coord = np.array(e3_2_list_for_coords)
+    ratio_e2_over_e3_coord = np.array(ratio_e2_over_e3_list)
+    ratio_e3_over_e2_coord = np.array(ratio_e3_over_e2_list)
+
+    #Output into ROOT Files
+
+    gr_e2_2 = TGraph(n_bin - 1, centrality_coord, e2_2_coord)
+    gr_e2_4 = TGraph(n_bin - 1, centrality_coord, e2_4_coord)
+    gr_e3_2 = TGraph(n_bin - 1, centrality_coord, e3_2_coord)
+    gr_e2_over_e3_ratio = TGraph(n_bin - 1, centrality_coord, ratio_e2_over_e3_coord)
+    gr_e3_over_e2_ratio = TGraph(n_bin - 1, centrality_coord, ratio_e3_over_e2_coord)
+
+    e_n_file = ROOT.TFile.Open('e_n_fluctuations_' + tag + '.root', 'RECREATE')
+
+    gr_e2_2.Write('e2_2_' + tag)
+    gr_e2_4.Write('e2_4_' + tag)
+    gr_e3_2.Write('e3_2_' + tag)
+    gr_e2_over_e3_ratio.Write('e2_over_e3_MAGMA')
+    gr_e3_over_e2_ratio.Write('e3_over_e2_MAGMA')
+
+    ##############################################################################
+    ########     Output histogram as a ROOT file for plots           #######
+    ##############################################################################
+
+    hist_e_tot.Write('Energy_Distribution_' + tag)
+    e_n_file.Close()
+
+#End of program
+print('it took', (time.time() - time_start), 's for ', nev, '  Pb-Pb events, ', len(prescriptions), ' prescriptions')
@@ -0,0 +1,1265 @@
+from __future__ import division
+import os
+import hashlib
+import shutil
+import tempfile
+import tracemalloc
+from collections import namedtuple, OrderedDict
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+import scipy.fft as sp_fft
+from scipy.special import binom
+try:
+    import numba
+except ImportError: #the 'jit' backends then fall back to NumPy
+    numba=None
+
+###############################################################
+###############################################################
+####     SHARED TOOLS FOR THE MAGMA DRIVER SCRIPTS.        #####
+####     (MAGMA_mod.py, MAGMA_orig.py, magma.py,           #####
+####      MAGMA_prescriptions.py and                       #####
+####      MAGMA_Source_Plots_final.py import from here)    #####
+###############################################################
+###############################################################
+
+#Trapezoidal rule along the last axis. Same as np.trapz (removed in recent numpy).
+def trapz(fun,zz):
+    dz=np.diff(zz)
+    return np.sum(dz*(fun[...,1:]+fun[...,:-1]),axis=-1)/2.
+
+#2-parameter fermi distribution for spherical nucleus
+def f2p(x,y,z,R,a):
+    return 1./(1+np.exp((np.sqrt(x**2+y**2+z**2)-R)/a))
+
+#Thickness function. Note that the overall normalization is not needed.
+def thick(x,y,lim,step,R,a):
+    zz=np.arange(0,lim+step,step)
+    fun=f2p(x,y,zz,R,a)
+    return 2.*trapz(fun,zz) #use symmetry
+
+#Thickness function on the whole (xx, yy) grid: T[j,k]=thick(xx[j],yy[k]).
+#The z integral is done for all points at once, in blocks of rows holding
+#at most 'block' values so that the (rows, ny, nz) temporary stays ~10 MB.
+def thick_table(xx,yy,lim,step,R,a,block=2**20):
+    zz=np.arange(0,lim+step,step)
+    T=np.zeros((xx.size,yy.size))
+    chunk=max(1,block//(yy.size*zz.size))
+    for j in range(0,xx.size,chunk):
+        x=xx[j:j+chunk,None,None]
+        y=yy[None,:,None]
+        T[j:j+chunk]=2.*trapz(f2p(x,y,zz,R,a),zz) #use symmetry
+    return T
+
+#Density of sources and saturation scale^2 in terms of the thickness T.
+def source_density(T,T0,Q0,m,Nc):
+    return (Nc**2-1)/(32*np.pi)*Q0**2*T/T0*1/np.log(1+Q0**2/m**2*T/T0)
+
+def saturation_scale2(T,T0,Q0):
+    return Q0**2*T/T0
+
+###############################################################
+####     RADIAL PROFILES. The Woods-Saxon nucleus is        ####
+####     spherical, so T, Qs^2 and n depend only on r.      ####
+###############################################################
+
+#1D table f(r) on a fine radius grid. Has the same ev/integral methods
+#as the RectBivariateSpline it replaces, so the event loop is unchanged.
+#Linear interpolation in r, with dr=0.01 fm the error is below 1e-5.
+class RadialProfile(object):
+    def __init__(self,rr,f):
+        self.rr=rr
+        self.f=f
+
+    def ev(self,x,y):
+        return np.interp(np.sqrt(x**2+y**2),self.rr,self.f)
+
+    #Integral over the box [xa,xb]x[ya,yb], trapezoidal rule with given step.
+    def integral(self,xa,xb,ya,yb,step=0.02):
+        xx=np.linspace(xa,xb,int(round((xb-xa)/step))+1)
+        yy=np.linspace(ya,yb,int(round((yb-ya)/step))+1)
+        f=self.ev(xx[:,None],yy[None,:])
+        return trapz(trapz(f,yy),xx)
+
+#T0 and radial profiles of T, n and Qs^2 for one nucleus.
+#The radius grid covers the corners of the [-lim, lim]^2 setup box.
+def radial_profiles(R,a,Q0,m,Nc,lim,step,dr=0.01):
+    rr=np.arange(0,np.sqrt(2)*lim+dr,dr)
+    T0=thick(0,0,lim,step,R,a) #fm^-2
+    T=thick_table(rr,np.zeros(1),lim,step,R,a)[:,0]
+    n=RadialProfile(rr,source_density(T,T0,Q0,m,Nc))
+    Q2=RadialProfile(rr,saturation_scale2(T,T0,Q0))
+    return T0,RadialProfile(rr,T),n,Q2
+
+###############################################################
+####     GEOMETRY TABLES WITH AN ON-DISK CACHE.             ####
+###############################################################
+
+#Everything the event loop needs from one nucleus. T, n and Q2 all have
+#ev(x,y) (RadialProfile or RectBivariateSpline), T0 and N are numbers.
+NucleusTables=namedtuple('NucleusTables',['T0','T','n','Q2','N'])
+
+#Format of the cached tables. Bump it whenever the code that builds them
+#changes, so that old caches are not served.
+_TABLES_VERSION=2
+
+#Radius step of the radial tables (fm).
+_RADIAL_DR=0.01
+
+#Arrays stored in the cache.
+_TABLE_ARRAYS=['rr','T','n','Q2','T0','N']
+
+#Build the tables from scratch. Only the arrays are returned (T, n and Q2 on
+#the grid rr), the splines and profiles are made from them in
+#_tables_from_arrays. N is the average number of sources in the box
+#[-box, box]^2.
+def _build_arrays(R,a,Q0,m,Nc,lim,step,box,radial):
+    if radial:
+        T0,T,n,Q2=radial_profiles(R,a,Q0,m,Nc,lim,step,_RADIAL_DR)
+        return {'rr':T.rr,'T':T.f,'n':n.f,'Q2':Q2.f,'T0':np.array(T0),'N':np.array(n.integral(-box,box,-box,box))}
+    xx=np.arange(-lim,lim+step,step)
+    T0=thick(0,0,lim,step,R,a) #fm^-2
+    T=thick_table(xx,xx,lim,step,R,a)
+    n=source_density(T,T0,Q0,m,Nc)
+    N=RectBivariateSpline(xx,xx,n).integral(-box,box,-box,box)
+    return {'rr':xx,'T':T,'n':n,'Q2':saturation_scale2(T,T0,Q0),'T0':np.array(T0),'N':np.array(N)}
+
+def _tables_from_arrays(arr,radial):
+    rr=arr['rr']
+    if radial:
+        prof=lambda f: RadialProfile(rr,f)
+    else:
+        prof=lambda f: RectBivariateSpline(rr,rr,f)
+    return NucleusTables(float(arr['T0']),prof(arr['T']),prof(arr['n']),prof(arr['Q2']),float(arr['N']))
+
+#Key of the cache: a hash of the table format and of everything the tables
+#depend on.
+def _cache_key(R,a,Q0,m,Nc,lim,step,box,radial):
+    pars=(_TABLES_VERSION,R,a,Q0,m,Nc,lim,step,box,radial,_RADIAL_DR if radial else None)
+    return hashlib.sha1(repr(tuple(repr(p) for p in pars)).encode()).hexdigest()[:16]
+
+#Tables already made in this process, by cache key. Identical nuclei
+#(e.g. Pb-Pb with a_A==a_B, R_A==R_B, Q0_A==Q0_B) get the very same
+#tables and splines for A and B instead of two copies.
+_loaded={}
+
+#Geometry tables of one nucleus. They only depend on (R, a, Q0, m, Nc, lim,
+#step), the box used for N and the radius step, so they are computed once and
+#stored as .npy files in cache_dir/<hash>/. Later runs load them
+#memory-mapped read-only. In radial mode the profiles of T, n and Q2 read
+#the mapped arrays directly, so many worker processes share a single copy
+#through the OS. In 2D mode the splines are fitted again in each process
+#from the mapped arrays and hold their own coefficients; only the build
+#is saved. cache_dir=None always rebuilds and writes nothing.
+def nucleus_tables(R,a,Q0,m,Nc,lim,step,box=12,radial=True,cache_dir='magma_cache'):
+    key=_cache_key(R,a,Q0,m,Nc,lim,step,box,radial)
+    if key not in _loaded:
+        _loaded[key]=_load_tables(key,R,a,Q0,m,Nc,lim,step,box,radial,cache_dir)
+    return _loaded[key]
+
+def _load_tables(key,R,a,Q0,m,Nc,lim,step,box,radial,cache_dir):
+    if cache_dir is None:
+        return _tables_from_arrays(_build_arrays(R,a,Q0,m,Nc,lim,step,box,radial),radial)
+    path=os.path.join(cache_dir,key)
+    if not os.path.isdir(path):
+        arr=_build_arrays(R,a,Q0,m,Nc,lim,step,box,radial)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        #Write into a temporary directory and rename it, so that workers
+        #starting at the same time never see half-written tables.
+        tmp=tempfile.mkdtemp(dir=cache_dir)
+        for name in arr:
+            np.save(os.path.join(tmp,name+'.npy'),arr[name])
+        try:
+            os.rename(tmp,path)
+        except OSError: #another process got there first
+            shutil.rmtree(tmp)
+    arr={}
+    for name in _TABLE_ARRAYS:
+        arr[name]=np.load(os.path.join(path,name+'.npy'),mmap_mode='r')
+    return _tables_from_arrays(arr,radial)
+
+###############################################################
+####     SAMPLING OF SOURCE COORDINATES.                    ####
+###############################################################
+
+#Draws source coordinates with density n(x,y) inside the box [-box, box]^2,
+#the same distribution as the rejection method in the drivers.
+#Radii come from the inverse cumulative distribution of r*n(r)*w(r), where
+#w(r) is the fraction of the circle of radius r inside the box (1 for r<box).
+#Azimuths are uniform over the arcs of that circle inside the box, so there
+#is no rejection and a fixed amount of work per source.
+#random can be np.random or a np.random.Generator.
+class RadialSampler(object):
+    def __init__(self,n,box):
+        self.box=box
+        rr=n.rr[n.rr<=np.sqrt(2)*box]
+        rr=np.append(rr,np.sqrt(2)*box)
+        w=1-4*self._alpha(rr)/np.pi
+        dens=2*np.pi*rr*w*n.ev(rr,0)
+        cdf=np.zeros(rr.size)
+        cdf[1:]=np.cumsum(np.diff(rr)*(dens[1:]+dens[:-1])/2.)
+        self.rr=rr
+        self.cdf=cdf
+        self.N=cdf[-1] #average number of sources in the box
+
+    #Half-width of the part of each quadrant outside the box, for radius r.
+    def _alpha(self,r):
+        return np.arccos(np.minimum(1.,self.box/np.maximum(r,1e-300)))
+
+    def sample(self,size,random=np.random):
+        r=np.interp(random.uniform(0,self.N,size=size),self.cdf,self.rr)
+        alpha=self._alpha(r)
+        quad=np.floor(random.uniform(0,4,size=size))
+        phi=quad*np.pi/2+alpha+random.uniform(0,1,size=size)*(np.pi/2-2*alpha)
+        return r*np.cos(phi),r*np.sin(phi)
+
+    #Same as sample, from uniforms u of shape (size,3) in [0,1) (radius,
+    #quadrant, azimuth in the quadrant).
+    def place(self,u):
+        r=np.interp(u[:,0]*self.N,self.cdf,self.rr)
+        alpha=self._alpha(r)
+        phi=np.floor(4*u[:,1])*np.pi/2+alpha+u[:,2]*(np.pi/2-2*alpha)
+        return r*np.cos(phi),r*np.sin(phi)
+
+#Sources of a chunk of events in ragged storage: one flat array per coordinate
+#and offsets, so the sources of event i are x[offsets[i]:offsets[i+1]].
+class SourceBatch(namedtuple('SourceBatch',['x','y','offsets'])):
+    __slots__=()
+
+    def counts(self):
+        return np.diff(self.offsets)
+
+    def event(self,i):
+        s=slice(self.offsets[i],self.offsets[i+1])
+        return self.x[s],self.y[s]
+
+#Poisson(N) sources for each of nev events, drawn with a few vectorized calls.
+#random can also be a list of per-event streams (see event_randoms), then
+#each event draws its count and then its uniforms from its own stream, into
+#one buffer for the chunk, and the coords of the whole chunk are placed by a
+#single inverse-CDF call. Only the two cheap draws are made per event.
+def sample_batch(sampler,N,nev,random=np.random):
+    offsets=np.zeros(nev+1,dtype=np.int64)
+    if isinstance(random,list):
+        offsets[1:]=np.cumsum([rnd.poisson(N) for rnd in random])
+        u=np.empty((offsets[-1],3))
+        for rnd,o0,o1 in zip(random,offsets[:-1],offsets[1:]):
+            rnd.random(out=u[o0:o1])
+        x,y=sampler.place(u)
+        return SourceBatch(x,y,offsets)
+    offsets[1:]=np.cumsum(random.poisson(N,size=nev))
+    x,y=sampler.sample(offsets[-1],random)
+    return SourceBatch(x,y,offsets)
+
+#Draws a b-centrality c from [c_min, c_max] as c=c_min+(c_max-c_min)*u**power,
+#u uniform. power>1 oversamples the central side of the range.
+#Returns c and the importance weight w=1/q(c) of the event, q being the density
+#of c, so that sums of w over events estimate min-bias counts: the fraction
+#of min-bias events with some property is sum(w*property)/nev.
+#The defaults give the usual uniform c in [0, 1] with w=1.
+def sample_centrality(random,c_min=0.,c_max=1.,power=1.):
+    dc=c_max-c_min
+    u=random.uniform(0,1)
+    c=c_min+dc*u**power
+    w=power*dc*u**(power-1)
+    return c,w
+
+###############################################################
+####     RANDOM STREAMS. One independent stream per event.  ####
+###############################################################
+
+#Random stream of event ev in a run with the given seed. It is the ev-th
+#child of SeedSequence(seed), so the results do not depend on how events are
+#split among processes, and any single event can be regenerated directly.
+def event_random(seed,ev):
+    return np.random.Generator(np.random.PCG64(np.random.SeedSequence(seed,spawn_key=(ev,))))
+
+#Streams of events first, ..., first+nev-1.
+def event_randoms(seed,first,nev):
+    return [event_random(seed,ev) for ev in range(first,first+nev)]
+
+###############################################################
+####     OVERLAP TESTS.                                     ####
+###############################################################
+
+#True if some source of A and some source of B are closer than 2*rad, i.e.
+#if their footprints (discs of radius rad) can overlap. If False, the product
+#rho_A*rho_B is exactly zero everywhere. A cheap bounding-box test comes first.
+def footprints_overlap(x_A,y_A,x_B,y_B,rad):
+    if x_A.size==0 or x_B.size==0:
+        return False
+    if (x_A.min()-x_B.max()>=2*rad or x_B.min()-x_A.max()>=2*rad or
+        y_A.min()-y_B.max()>=2*rad or y_B.min()-y_A.max()>=2*rad):
+        return False
+    d2=np.subtract.outer(x_A,x_B)**2+np.subtract.outer(y_A,y_B)**2
+    return d2.min()<(2*rad)**2
+
+#Sources of x, y that have some source of xo, yo closer than d, by blocks
+#of sources against all others after a bounding-box cut.
+def _near(x,y,xo,yo,d,block=1024):
+    near=np.zeros(x.size,dtype=bool)
+    if x.size==0 or xo.size==0:
+        return near
+    box=np.nonzero((x>xo.min()-d)&(x<xo.max()+d)&(y>yo.min()-d)&(y<yo.max()+d))[0]
+    for s in range(0,box.size,block):
+        i=box[s:s+block]
+        d2=(x[i,None]-xo[None,:])**2+(y[i,None]-yo[None,:])**2
+        near[i]=d2.min(axis=1)<d**2
+    return near
+
+#Sources that can contribute to the product rho_A*rho_B. A source of A only
+#adds to cells within rad of it, and rho_B is zero on every cell farther
+#than rad from all sources of B, so a source of A farther than 2*rad from all
+#sources of B adds only where rho_B=0 (and vice versa). Dropping such sources
+#leaves the product unchanged, bit for bit. The distance is widened by 1e-9
+#relative so that rounding never drops a contributing source.
+#Returns the masks of the sources of A and of B to keep.
+def overlap_support(x_A,y_A,x_B,y_B,rad):
+    d=2*rad*(1+1e-9)
+    return _near(x_A,y_A,x_B,y_B,d),_near(x_B,y_B,x_A,y_A,d)
+
+#Rows and columns of the grid xx, yy (as slices) that cover every cell where
+#the product can be non-zero: the cells within rad of some source of A and
+#of some source of B lie in the intersection of the bounding boxes of both
+#sets of sources widened by rad. Cropping the event grid to it keeps every
+#non-zero cell of rho_A*rho_B at the same cell size. A window of one cell
+#(at the edge of the grid) is widened to two, since the depositions take the
+#cell size from the first two cells.
+def overlap_window(xx,yy,x_A,y_A,x_B,y_B,rad):
+    x1=max(x_A.min(),x_B.min())
+    x2=min(x_A.max(),x_B.max())
+    y1=max(y_A.min(),y_B.min())
+    y2=min(y_A.max(),y_B.max())
+    k1,k2=_window(xx,(x1+x2)/2,(x2-x1)/2+rad)
+    i1,i2=_window(yy,(y1+y2)/2,(y2-y1)/2+rad)
+    return _two_cells(i1,i2,yy.size),_two_cells(k1,k2,xx.size)
+
+def _two_cells(i1,i2,n):
+    if i2-i1==1:
+        return slice(i1,i2+1) if i2<n else slice(i1-1,i2)
+    return slice(i1,max(i1,i2))
+
+###############################################################
+####     DEPOSITION OF SOURCES ON THE EVENT GRID.           ####
+####     Every source j adds amp_j/(r^2+inv_q2_j) to the    ####
+####     cells within r<rad (rad=1/m) of its position.      ####
+####     rho[i,k] is at x=xx[k], y=yy[i], as in meshgrid.   ####
+###############################################################
+
+#Range of indices of the uniform axis aa with aa[i] in (a-rad, a+rad),
+#widened by one cell on each side (the exact cut is done on r afterwards).
+def _window(aa,a,rad):
+    h=aa[1]-aa[0]
+    i1=(a-rad-aa[0])/h
+    i2=(a+rad-aa[0])/h
+    lo=int(np.floor(min(i1,i2)))
+    hi=int(np.ceil(max(i1,i2)))+1
+    return max(lo,0),min(hi,aa.size)
+
+#A grid (ny, nx) as a stack of one grid, and amp as (nout, n) for the stack.
+def _stack(rho,amp,x):
+    if rho.ndim==3:
+        return rho,np.broadcast_to(amp,(len(rho),)+x.shape)
+    return rho[None],np.broadcast_to(amp,x.shape)[None]
+
+#Each source only touches the window of cells covering its footprint, so the
+#cost scales with the footprint area instead of the grid area.
+#rho can also be a stack of grids (nout, ny, nx) with amp of shape (nout, n):
+#the window, distances and kernel denominators of a source are then computed
+#once and shared by all grids (e.g. several prescriptions from one sampling).
+def deposit_local(rho,xx,yy,x,y,amp,inv_q2,rad):
+    stack,amp=_stack(rho,amp,x)
+    inv_q2=np.broadcast_to(inv_q2,x.shape)
+    for j in range(x.size):
+        k1,k2=_window(xx,x[j],rad)
+        i1,i2=_window(yy,y[j],rad)
+        if k1>=k2 or i1>=i2:
+            continue
+        x_loop=xx[None,k1:k2]-x[j]
+        y_loop=yy[i1:i2,None]-y[j]
+        r2=x_loop**2+y_loop**2
+        inside=np.sqrt(r2)<rad #evaluate only within radius rad
+        den=r2[inside]+inv_q2[j]
+        for o in range(len(stack)):
+            patch=stack[o,i1:i2,k1:k2]
+            patch[inside]+=amp[o,j]/den
+    return rho
+
+#Adds vals to the cells (ii, kk) of rho, dropping those outside the grid.
+#Repeated cells are summed, all in one np.bincount. rho can be a view of a
+#larger grid (e.g. a window): it is then added to in place, not through a
+#flat copy.
+def _add_patches(rho,ii,kk,vals):
+    ok=(ii>=0)&(ii<rho.shape[0])&(kk>=0)&(kk<rho.shape[1])
+    sums=np.bincount((ii*rho.shape[1]+kk)[ok],vals[ok],minlength=rho.size)
+    if rho.flags.c_contiguous:
+        flat=rho.reshape(-1)
+        flat+=sums
+    else:
+        rho+=sums.reshape(rho.shape)
+
+#All sources of a block at once: the (cell, contribution) pairs of the
+#(2w+1)^2 windows around block sources are built together and accumulated
+#with np.bincount, so there is no Python loop over sources. block bounds the
+#memory to a few block*(2w+1)^2 arrays. Stacks of grids as in deposit_local.
+def deposit_scatter(rho,xx,yy,x,y,amp,inv_q2,rad,block=256):
+    stack,amp=_stack(rho,amp,x)
+    inv_q2=np.broadcast_to(inv_q2,x.shape)
+    hx=xx[1]-xx[0]
+    hy=yy[1]-yy[0]
+    wx=int(np.ceil(rad/abs(hx)))+1
+    wy=int(np.ceil(rad/abs(hy)))+1
+    di=np.arange(-wy,wy+1)[:,None]
+    dk=np.arange(-wx,wx+1)[None,:]
+    for s in range(0,x.size,block):
+        xs=x[s:s+block,None,None]
+        ys=y[s:s+block,None,None]
+        ii=np.round((ys-yy[0])/hy).astype(int)+di
+        kk=np.round((xs-xx[0])/hx).astype(int)+dk
+        x_loop=xx[np.clip(kk,0,xx.size-1)]-xs
+        y_loop=yy[np.clip(ii,0,yy.size-1)]-ys
+        r2=x_loop**2+y_loop**2
+        inside=np.sqrt(r2)<rad #evaluate only within radius rad
+        den=r2+inv_q2[s:s+block,None,None]
+        for o in range(len(stack)):
+            vals=np.where(inside,amp[o,s:s+block,None,None]/den,0.)
+            _add_patches(stack[o],ii,kk,vals)
+    return rho
+
+#Tiles of tile x tile cells of the grid xx, yy for fine grids (size~1000
+#and more), with the list of sources reaching each tile. sources is a list of
+#(x, y) arrays (e.g. the sources of A and of B); yields rows and cols of the
+#tile (as slices) and the indices of the sources of each set whose footprint
+#box (widened by a cell) overlaps the tile, for the tiles reached by some
+#source. Depositing the listed sources on xx[cols], yy[rows] gives exactly
+#the cells of the full-grid deposition, so an event can be built tile by tile
+#with tile-sized buffers for the per-nucleus grids.
+def grid_tiles(xx,yy,sources,rad,tile=256):
+    d=rad+max(abs(xx[1]-xx[0]),abs(yy[1]-yy[0]))
+    for rows in _tile_slices(yy.size,tile):
+        y1,y2=sorted((yy[rows][0],yy[rows][-1]))
+        for cols in _tile_slices(xx.size,tile):
+            x1,x2=sorted((xx[cols][0],xx[cols][-1]))
+            idx=[np.nonzero((x>x1-d)&(x<x2+d)&(y>y1-d)&(y<y2+d))[0] for x,y in sources]
+            if any(i.size for i in idx):
+                yield rows,cols,idx
+
+#Slices of n cells in tiles of tile cells. A last tile of a single cell is
+#folded into the previous one, since the depositions take the cell size from
+#the first two cells of the grid they are given.
+def _tile_slices(n,tile):
+    starts=list(range(0,n,tile))
+    if len(starts)>1 and n-starts[-1]<2:
+        starts.pop()
+    return [slice(a,b) for a,b in zip(starts,starts[1:]+[n])]
+
+#Local-Qs deposition (the MODIFICATION OF GG in the drivers): amp and inv_q2
+#are fields on the grid instead of values per source, e.g. amp=8/g^2/Nc*Qs_B^2
+#and inv_q2=1/Qs_A^2 at every cell. They are computed once per event and
+#gathered on the windows of blocks of sources as in deposit_scatter, so this
+#costs about the same as the standard deposition.
+def deposit_local_qs(rho,xx,yy,x,y,amp,inv_q2,rad,block=256):
+    amp=np.broadcast_to(amp,rho.shape)
+    hx=xx[1]-xx[0]
+    hy=yy[1]-yy[0]
+    wx=int(np.ceil(rad/abs(hx)))+1
+    wy=int(np.ceil(rad/abs(hy)))+1
+    di=np.arange(-wy,wy+1)[:,None]
+    dk=np.arange(-wx,wx+1)[None,:]
+    for s in range(0,x.size,block):
+        xs=x[s:s+block,None,None]
+        ys=y[s:s+block,None,None]
+        ii=np.round((ys-yy[0])/hy).astype(int)+di
+        kk=np.round((xs-xx[0])/hx).astype(int)+dk
+        ic=np.clip(ii,0,yy.size-1)
+        kc=np.clip(kk,0,xx.size-1)
+        x_loop=xx[kc]-xs
+        y_loop=yy[ic]-ys
+        r2=x_loop**2+y_loop**2
+        inside=np.sqrt(r2)<rad #evaluate only within radius rad
+        vals=np.where(inside,amp[ic,kc]/(r2+inv_q2[ic,kc]),0.)
+        _add_patches(rho,ii,kk,vals)
+    return rho
+
+#Precomputed kernel patches 1/(r^2+inv_q2), truncated at r<rad, on the cells
+#around a source. A patch only depends on the sub-cell offset of the source,
+#tabulated at the centers of nsub x nsub sub-cells per cell, and on inv_q2,
+#tabulated on nq levels equally spaced in log(inv_q2) between iq_min and
+#iq_max. Each source takes the patch of its nearest sub-cell and level (one
+#gather for a block of sources), added to the grid with np.bincount.
+#Sources with inv_q2 outside [iq_min, iq_max] are deposited exactly.
+#The lookup moves a source by up to half a sub-cell and its inv_q2 by up to
+#half a level, so nsub and nq set the tolerance; most of the error is at the
+#1/m cut, where the moved footprint gains or loses cells. accuracy()
+#measures it against the exact deposition. The product rho_A*rho_B of
+#MAGMA_mod amplifies it where the footprints are cut: over 40 events against
+#the 'loop' reference, the defaults (nsub=8, nq=32) give a median error of
+#1.1% on e_tot (up to 1.7% for b<10 fm, 7% in peripheral events) and up to
+#0.07 on |eps_3|; nsub=16, nq=64 give 0.4% (4.8%) and 0.04. The lookup is
+#about as fast as deposit_scatter at size 100 (0.9 ms for 200 sources) and
+#slower than deposit_local on fine grids, where the tables also get large.
+#Patches are built on first use for the cell size of the grid, the tables
+#take nsub^2*nq*(2*ceil(rad/h)+3)^2*8 bytes. They are keyed on the steps
+#rounded as in FFTDeposition, so the cropped windows of one grid share a
+#table, and kept in an LRU store of at most max_bytes.
+class StencilCache(object):
+    def __init__(self,rad,iq_min,iq_max,nsub=8,nq=32,block=256,max_bytes=256*2**20):
+        self.rad=rad
+        self.iq_min=iq_min
+        self.iq_max=iq_max
+        self.nsub=nsub
+        self.nq=nq
+        self.block=block
+        self.u=np.linspace(np.log(iq_min),np.log(iq_max),nq)
+        self.max_bytes=max_bytes
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.patches=OrderedDict()
+
+    def _patches(self,hx,hy):
+        #Steps of windows of one grid differ by rounding only.
+        hx=float('%.12g'%hx)
+        hy=float('%.12g'%hy)
+        if (hx,hy) in self.patches:
+            self.hits+=1
+            self.patches[(hx,hy)]=self.patches.pop((hx,hy)) #most recently used last
+        else:
+            self.misses+=1
+            wx=int(np.ceil(self.rad/abs(hx)))+1
+            wy=int(np.ceil(self.rad/abs(hy)))+1
+            off=(np.arange(self.nsub)+0.5)/self.nsub-0.5 #sub-cell centers in units of cells
+            dx=(np.arange(-wx,wx+1)[None,:]-off[:,None])*hx #(nsub, 2wx+1)
+            dy=(np.arange(-wy,wy+1)[None,:]-off[:,None])*hy #(nsub, 2wy+1)
+            r2=dy[:,None,None,:,None]**2+dx[None,:,None,None,:]**2 #(sy, sx, l, i, k)
+            iq=np.exp(self.u)[None,None,:,None,None]
+            P=np.where(np.sqrt(r2)<self.rad,1/(r2+iq),0.)
+            self.patches[(hx,hy)]=(wx,wy,P)
+            self.nbytes+=P.nbytes
+            while self.nbytes>self.max_bytes and len(self.patches)>1:
+                self.nbytes-=self.patches.popitem(last=False)[1][2].nbytes
+        return self.patches[(hx,hy)]
+
+    def __call__(self,rho,xx,yy,x,y,amp,inv_q2,rad):
+        if rad!=self.rad:
+            raise ValueError('StencilCache was built for rad=%g, not %g'%(self.rad,rad))
+        stack,amp=_stack(rho,amp,x)
+        inv_q2=np.broadcast_to(inv_q2,x.shape)
+        exact=(inv_q2<self.iq_min)|(inv_q2>self.iq_max)
+        if exact.any():
+            deposit_local(stack,xx,yy,x[exact],y[exact],amp[:,exact],inv_q2[exact],rad)
+        x,y,amp,inv_q2=x[~exact],y[~exact],amp[:,~exact],inv_q2[~exact]
+        hx=xx[1]-xx[0]
+        hy=yy[1]-yy[0]
+        wx,wy,P=self._patches(hx,hy)
+        di=np.arange(-wy,wy+1)[:,None]
+        dk=np.arange(-wx,wx+1)[None,:]
+        for s in range(0,x.size,self.block):
+            #Nearest cell, sub-cell and inv_q2 level of each source.
+            u=(x[s:s+self.block]-xx[0])/hx
+            v=(y[s:s+self.block]-yy[0])/hy
+            k0=np.round(u).astype(int)
+            i0=np.round(v).astype(int)
+            sx=np.clip(np.floor((u-k0+0.5)*self.nsub).astype(int),0,self.nsub-1)
+            sy=np.clip(np.floor((v-i0+0.5)*self.nsub).astype(int),0,self.nsub-1)
+            l=np.clip(np.round((np.log(inv_q2[s:s+self.block])-self.u[0])/(self.u[1]-self.u[0])).astype(int),0,self.nq-1)
+            patch=P[sy,sx,l]
+            for o in range(len(stack)):
+                _add_patches(stack[o],i0[:,None,None]+di,k0[:,None,None]+dk,patch*amp[o,s:s+self.block,None,None])
+        return rho
+
+    #Largest error on a cell relative to the largest cell value, and relative
+    #error of the sum, for the given sources against the exact deposition.
+    def accuracy(self,xx,yy,x,y,amp,inv_q2,rad):
+        exact=deposit_local(np.zeros((yy.size,xx.size)),xx,yy,x,y,amp,inv_q2,rad)
+        approx=self(np.zeros((yy.size,xx.size)),xx,yy,x,y,amp,inv_q2,rad)
+        return np.max(np.abs(approx-exact))/np.max(exact),abs(np.sum(approx)/np.sum(exact)-1)
+
+#FFT deposition. Sources are split into classes of inv_q2 (ncls levels
+#equally spaced in log(inv_q2), each source shared linearly between its two
+#nearest levels). The sources of a class are binned onto the grid with
+#cloud-in-cell weights and convolved with the truncated kernel of that class,
+#whose spectrum is cached. The spectra of all classes are summed before one
+#inverse FFT, so the cost is ~(ncls+1) FFTs of the grid whatever the number
+#of sources. The grid is padded by the kernel radius so that the convolution
+#does not wrap around. Binning moves sources by less than a cell, so this
+#is meant for fine grids (size~300 and more): there cells are off by up to
+#~3% (sharing sources between the levels, ~1% with ncls=64) and e_tot by
+#less than 0.2%. At size~100 the binning raises the cell errors to ~10%.
+#Sources with inv_q2 outside [iq_min, iq_max] are deposited exactly.
+#The spectra depend only on the padded shape and the steps, so cropped
+#grids of different shapes share a few entries. They are kept in an
+#LRU store of at most max_bytes (hits and misses count the lookups).
+class FFTDeposition(object):
+    def __init__(self,rad,iq_min,iq_max,ncls=16,max_bytes=256*2**20):
+        self.rad=rad
+        self.iq_min=iq_min
+        self.iq_max=iq_max
+        self.ncls=ncls
+        self.u=np.linspace(np.log(iq_min),np.log(iq_max),ncls)
+        self.max_bytes=max_bytes
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.spectra=OrderedDict()
+
+    #Padding, padded shape and kernel spectra of every class for this grid.
+    def _spectra(self,ny,nx,hx,hy):
+        wx=int(np.ceil(self.rad/abs(hx)))+1
+        wy=int(np.ceil(self.rad/abs(hy)))+1
+        #Padded sizes rounded up to multiples of 16 before the fast length,
+        #so that the cropped grids of different events share a few shapes.
+        shape=(sp_fft.next_fast_len(-(-(ny+2*wy)//16)*16),sp_fft.next_fast_len(-(-(nx+2*wx)//16)*16))
+        #Steps of windows of one grid differ by rounding only.
+        hx=float('%.12g'%hx)
+        hy=float('%.12g'%hy)
+        key=(shape,hx,hy)
+        if key in self.spectra:
+            self.hits+=1
+            self.spectra[key]=self.spectra.pop(key) #most recently used last
+            return (wx,wy,shape,self.spectra[key])
+        self.misses+=1
+        di=np.fft.fftfreq(shape[0],1./shape[0])[:,None] #0, 1, ..., -1
+        dk=np.fft.fftfreq(shape[1],1./shape[1])[None,:]
+        r2=(di*hy)**2+(dk*hx)**2
+        inside=np.sqrt(r2)<self.rad
+        K=[sp_fft.rfft2(np.where(inside,1/(r2+np.exp(u)),0.)) for u in self.u]
+        self.spectra[key]=K
+        self.nbytes+=sum(k.nbytes for k in K)
+        while self.nbytes>self.max_bytes and len(self.spectra)>1:
+            self.nbytes-=sum(k.nbytes for k in self.spectra.popitem(last=False)[1])
+        return (wx,wy,shape,K)
+
+    def __call__(self,rho,xx,yy,x,y,amp,inv_q2,rad):
+        if rad!=self.rad:
+            raise ValueError('FFTDeposition was built for rad=%g, not %g'%(self.rad,rad))
+        if rho.ndim==3:
+            #The binning depends on amp, so each grid of a stack is convolved apart.
+            for o in range(len(rho)):
+                self(rho[o],xx,yy,x,y,_stack(rho,amp,x)[1][o],inv_q2,rad)
+            return rho
+        amp=np.broadcast_to(amp,x.shape)
+        inv_q2=np.broadcast_to(inv_q2,x.shape)
+        exact=(inv_q2<self.iq_min)|(inv_q2>self.iq_max)
+        if exact.any():
+            deposit_local(rho,xx,yy,x[exact],y[exact],amp[exact],inv_q2[exact],rad)
+        x,y,amp,inv_q2=x[~exact],y[~exact],amp[~exact],inv_q2[~exact]
+        if x.size==0:
+            return rho
+        ny,nx=rho.shape
+        hx=xx[1]-xx[0]
+        hy=yy[1]-yy[0]
+        wx,wy,shape,K=self._spectra(ny,nx,hx,hy)
+        #Cloud-in-cell weights on the padded grid.
+        u=(x-xx[0])/hx+wx
+        v=(y-yy[0])/hy+wy
+        k0=np.floor(u).astype(int)
+        i0=np.floor(v).astype(int)
+        fx=u-k0
+        fy=v-i0
+        ii=(i0[:,None]+[0,0,1,1]).ravel()
+        kk=(k0[:,None]+[0,1,0,1]).ravel()
+        w=np.stack([(1-fy)*(1-fx),(1-fy)*fx,fy*(1-fx),fy*fx],axis=1)*amp[:,None]
+        #Class levels of each source.
+        lq=(np.log(inv_q2)-self.u[0])/(self.u[1]-self.u[0])
+        l=np.clip(np.floor(lq).astype(int),0,self.ncls-2)
+        t=(lq-l)[:,None]
+        cls=np.concatenate([np.repeat(l,4),np.repeat(l+1,4)])
+        wc=np.concatenate([(w*(1-t)).ravel(),(w*t).ravel()])
+        ii=np.tile(ii,2)
+        kk=np.tile(kk,2)
+        ok=(ii>=0)&(ii<shape[0])&(kk>=0)&(kk<shape[1])
+        cls,ii,kk,wc=cls[ok],ii[ok],kk[ok],wc[ok]
+        spec=0.
+        for c in np.unique(cls):
+            sel=cls==c
+            H=np.bincount(ii[sel]*shape[1]+kk[sel],wc[sel],minlength=shape[0]*shape[1])
+            spec=spec+sp_fft.rfft2(H.reshape(shape))*K[c]
+        rho+=sp_fft.irfft2(spec,shape)[wy:wy+ny,wx:wx+nx]
+        return rho
+
+#Compiled version of deposit_local: tight loops over sources and the cells
+#of their window, no temporary arrays. Falls back to deposit_local without
+#numba. Same results as deposit_local within floating point rounding.
+def deposit_jit(rho,xx,yy,x,y,amp,inv_q2,rad):
+    if numba is None:
+        return deposit_local(rho,xx,yy,x,y,amp,inv_q2,rad)
+    stack,amp=_stack(rho,amp,x)
+    amp=np.ascontiguousarray(amp,dtype=rho.dtype)
+    inv_q2=np.ascontiguousarray(np.broadcast_to(inv_q2,x.shape),dtype=rho.dtype)
+    _deposit_jit(stack,xx,yy,x,y,amp,inv_q2,float(rad))
+    return rho
+
+def _deposit_loops(stack,xx,yy,x,y,amp,inv_q2,rad):
+    hx=xx[1]-xx[0]
+    hy=yy[1]-yy[0]
+    for j in range(x.size):
+        k1=(x[j]-rad-xx[0])/hx
+        k2=(x[j]+rad-xx[0])/hx
+        i1=(y[j]-rad-yy[0])/hy
+        i2=(y[j]+rad-yy[0])/hy
+        k_lo=max(int(np.floor(min(k1,k2))),0)
+        k_hi=min(int(np.ceil(max(k1,k2)))+1,xx.size)
+        i_lo=max(int(np.floor(min(i1,i2))),0)
+        i_hi=min(int(np.ceil(max(i1,i2)))+1,yy.size)
+        for i in range(i_lo,i_hi):
+            y_loop=yy[i]-y[j]
+            for k in range(k_lo,k_hi):
+                x_loop=xx[k]-x[j]
+                r2=x_loop**2+y_loop**2
+                if np.sqrt(r2)<rad: #evaluate only within radius rad
+                    den=r2+inv_q2[j]
+                    for o in range(stack.shape[0]):
+                        stack[o,i,k]+=amp[o,j]/den
+
+if numba is not None:
+    _deposit_jit=numba.njit(cache=True)(_deposit_loops)
+
+#Deposition backends, selected by name. A callable with the signature of
+#deposit_local (a StencilCache or FFTDeposition) can also be given as method.
+#All of them accept a stack of grids (nout, ny, nx) with amp of shape (nout, n).
+_deposit_methods={'local':deposit_local,'scatter':deposit_scatter,'jit':deposit_jit}
+
+#With a float32 rho (single-precision mode) the coordinates and amplitudes
+#are converted too, so that the whole deposition runs in float32.
+def deposit(rho,xx,yy,x,y,amp,inv_q2,rad,method='local'):
+    if rho.dtype!=np.float64:
+        xx,yy,x,y,amp,inv_q2=[np.asarray(a,dtype=rho.dtype) for a in (xx,yy,x,y,amp,inv_q2)]
+    if callable(method):
+        return method(rho,xx,yy,x,y,amp,inv_q2,rad)
+    return _deposit_methods[method](rho,xx,yy,x,y,amp,inv_q2,rad)
+
+###############################################################
+####     FIELDS OF THE NUCLEI ON THE EVENT GRID.            ####
+###############################################################
+
+#profile (Q2_X or T_X, centered at the origin) of a nucleus centered at
+#x=-sign*b/2 on the grid xx, yy: sign=+1 for A, -1 for B as in the drivers.
+def grid_field(profile,sign,b,xx,yy):
+    x_grid,y_grid=np.broadcast_arrays(xx[None,:]+sign*b/2,yy[:,None])
+    return profile.ev(x_grid,y_grid)
+
+#LRU cache of the fields 'QA', 'QB' (Qs^2) and 'TA', 'TB' (WS thickness) of
+#both nuclei on the event grid, keyed by the field, the grid and b. With
+#db=None the key is b itself, so results are exactly those of an uncached
+#evaluation. Min-bias b then never repeats, so only the last field of each
+#name is kept: fixed-b runs reuse it every event and nothing else is held.
+#With db>0, b is rounded to a multiple of db and the field is evaluated at
+#the rounded b, so b-sorted batches (impact-parameter binning) share fields
+#at the cost of a shift of up to db/2, and the least recently used fields
+#are dropped once they take more than max_bytes. hits and misses count the
+#lookups. Cached fields are read-only, use a copy to modify them.
+#Fields derived from these are cached the same way: 'inv_QA' is 1/Qs_A^2 and
+#'amp_QA' is amp*Qs_A^2 (e.g. amp=8/g^2/Nc for the local-Qs deposition), and
+#the same for B, so that they are not remade as temporaries every event.
+class GridFieldCache(object):
+    def __init__(self,Q2_A,Q2_B,T_A=None,T_B=None,db=None,max_bytes=64*2**20,amp=1.):
+        self.profiles={'QA':(Q2_A,1),'QB':(Q2_B,-1),'TA':(T_A,1),'TB':(T_B,-1)}
+        self.amp=amp
+        self.db=db
+        self.max_bytes=max_bytes
+        self.nbytes=0
+        self.hits=0
+        self.misses=0
+        self.fields=OrderedDict()
+
+    def get(self,name,b,xx,yy):
+        if self.db:
+            b=np.round(b/self.db)*self.db
+        key=(name,float(b),xx[0],xx[-1],xx.size,yy[0],yy[-1],yy.size)
+        if key in self.fields:
+            self.hits+=1
+            self.fields[key]=self.fields.pop(key) #most recently used last
+            return self.fields[key]
+        self.misses+=1
+        if name.startswith('inv_'):
+            field=1/self.get(name[4:],b,xx,yy)
+        elif name.startswith('amp_'):
+            field=self.amp*self.get(name[4:],b,xx,yy)
+        else:
+            profile,sign=self.profiles[name]
+            if profile is None:
+                raise ValueError('no profile given for the field %r'%name)
+            field=grid_field(profile,sign,b,xx,yy)
+        field.setflags(write=False)
+        if not self.db:
+            for k in [k for k in self.fields if k[0]==name]:
+                self.nbytes-=self.fields.pop(k).nbytes
+        self.fields[key]=field
+        self.nbytes+=field.nbytes
+        while self.nbytes>self.max_bytes and len(self.fields)>1:
+            self.nbytes-=self.fields.popitem(last=False)[1].nbytes
+        return field
+
+###############################################################
+####     PRESCRIPTIONS. How the grids of nuclei A and B     ####
+####     are combined into the energy density.              ####
+###############################################################
+
+#Per-nucleus grids of an event, by name:
+#  'A', 'B'     kernels of the sources with amplitude amp,
+#  'A_w', 'B_w' the same with each source weighted by Qs^2 of the other
+#               nucleus at its position (original MAGMA),
+#  'QA', 'QB'   Qs^2 of each nucleus on the grid (WS thickness times Q0^2/T0),
+#  'TA', 'TB'   WS thickness of each nucleus on the grid (needs fields),
+#  'A_gg','B_gg' local-Qs deposition, Qs^2 of both nuclei taken at each cell
+#               instead of at the source (MODIFICATION OF GG).
+#Only the grids in needs are made. A and A_w (B and B_w) share the kernels
+#through one deposition on a stack of grids. x_A, x_B are shifted by -b/2,
+#+b/2 and Q2_A, Q2_B are centered at the origin, as in the drivers.
+#Fields on the grid come from fields (a GridFieldCache) if given.
+def event_grids(needs,xx,yy,x_A,y_A,x_B,y_B,b,Q2_A,Q2_B,amp,rad,method='local',fields=None):
+    grids={}
+    for X,x,y,Q2_X,Q2_Y,s in [('A',x_A,y_A,Q2_A,Q2_B,1),('B',x_B,y_B,Q2_B,Q2_A,-1)]:
+        rows=[n for n in (X,X+'_w') if n in needs]
+        if not rows:
+            continue
+        amps=[amp*np.ones(x.size) if n==X else amp*Q2_Y.ev(x-s*b/2,y) for n in rows]
+        stack=deposit(np.zeros((len(rows),yy.size,xx.size)),xx,yy,x,y,np.array(amps),1/Q2_X.ev(x+s*b/2,y),rad,method)
+        grids.update(zip(rows,stack))
+    if set(needs) & set(['QA','QB','A_gg','B_gg']):
+        if fields is None:
+            grids['QA']=grid_field(Q2_A,1,b,xx,yy)
+            grids['QB']=grid_field(Q2_B,-1,b,xx,yy)
+        else:
+            grids['QA']=fields.get('QA',b,xx,yy)
+            grids['QB']=fields.get('QB',b,xx,yy)
+    for name in ('TA','TB'):
+        if name in needs:
+            if fields is None:
+                raise ValueError('the field %r needs a GridFieldCache with T_A and T_B'%name)
+            grids[name]=fields.get(name,b,xx,yy)
+    if 'A_gg' in needs:
+        grids['A_gg']=deposit_local_qs(np.zeros((yy.size,xx.size)),xx,yy,x_A,y_A,amp*grids['QB'],1/grids['QA'],rad)
+    if 'B_gg' in needs:
+        grids['B_gg']=deposit_local_qs(np.zeros((yy.size,xx.size)),xx,yy,x_B,y_B,amp*grids['QA'],1/grids['QB'],rad)
+    return grids
+
+#A prescription: a name for the outputs, the grids it needs and the function
+#that combines them into the density (before the conversion to GeV).
+Prescription=namedtuple('Prescription',['tag','needs','combine'])
+
+#Generalized mean ((A^p+B^p)/2)^(1/p) as in TRENTo: p=1 arithmetic,
+#p=0 geometric sqrt(A*B), p=-1 harmonic. For p<=0 it is 0 where A or B is 0.
+def generalized_mean(A,B,p):
+    if p==0:
+        return np.sqrt(A*B)
+    if p>0:
+        return ((A**p+B**p)/2)**(1/p)
+    both=(A>0)&(B>0)
+    out=np.zeros_like(A)
+    out[both]=((A[both]**p+B[both]**p)/2)**(1/p)
+    return out
+
+#Prescriptions by name:
+#  'orig'      A_w + B_w, original MAGMA (MAGMA_orig.py),
+#  'product'   A x B (MAGMA_mod.py),
+#  'sum'       A + B,
+#  'geometric' sqrt(A x B), TRENTo-type,
+#  'mean'      generalized mean with parameter p,
+#  'cross_ws'  A x Qs_B^2 + Qs_A^2 x B, the A x B_WS + A_WS x B of magmacomp.C
+#              with the WS profiles on the grid instead of at the sources,
+#  'gg'        A_gg + B_gg, original MAGMA with local Qs (MODIFICATION OF GG).
+def prescription(name,p=1.):
+    if name=='orig':
+        return Prescription('MAGMA',('A_w','B_w'),lambda g: g['A_w']+g['B_w'])
+    if name=='product':
+        return Prescription('MAGMA_mod',('A','B'),lambda g: g['A']*g['B'])
+    if name=='sum':
+        return Prescription('MAGMA_sum',('A','B'),lambda g: g['A']+g['B'])
+    if name=='geometric':
+        return Prescription('MAGMA_sqrt',('A','B'),lambda g: np.sqrt(g['A']*g['B']))
+    if name=='mean':
+        return Prescription('MAGMA_mean_p%g'%p,('A','B'),lambda g: generalized_mean(g['A'],g['B'],p))
+    if name=='cross_ws':
+        return Prescription('MAGMA_ws',('A','B','QA','QB'),lambda g: g['A']*g['QB']+g['QA']*g['B'])
+    if name=='gg':
+        return Prescription('MAGMA_gg',('A_gg','B_gg'),lambda g: g['A_gg']+g['B_gg'])
+    raise ValueError('unknown prescription %r'%name)
+
+###############################################################
+####     OBSERVABLES. Total energy, centroid, rms radius,   ####
+####     epsilon_2 and epsilon_3 of a density on the grid.  ####
+###############################################################
+
+#Same algebra of 2D grids as the drivers always used:
+#E2=-sum(rho*z^2)/sum(rho*r^2), E3=-sum(rho*z^3)/sum(rho*r^3), z=x+iy
+#around the centroid, rms=sqrt(sum(rho*r^2)/e_tot).
+#Returns e_tot, center_x, center_y, rms, E2, E3, all zero if e_tot==0.
+def _moments_numpy(rho,xx,yy):
+    e_tot=np.sum(rho)
+    if e_tot==0:
+        return 0.,0.,0.,0.,0j,0j
+    #Recentering correction
+    center_x=np.sum(rho*xx[None,:])/e_tot
+    center_y=np.sum(rho*yy[:,None])/e_tot
+    x_cen=xx[None,:]-center_x
+    y_cen=yy[:,None]-center_y
+    #RMS radius, eccentricity, triangularity
+    z=x_cen+y_cen*1.j
+    r2=x_cen**2+y_cen**2
+    r3=r2**(3/2.)
+    e2_den=np.sum(rho*r2)
+    E2=-np.sum(rho*z**2)/e2_den
+    E3=-np.sum(rho*z**3)/np.sum(rho*r3)
+    return e_tot,center_x,center_y,np.sqrt(e2_den/e_tot),E2,E3
+
+#Two passes over the grid (centroid, then moments) with no temporaries.
+def _moments_loops(rho,xx,yy):
+    e_tot=0.
+    sx=0.
+    sy=0.
+    for i in range(yy.size):
+        for k in range(xx.size):
+            e_tot+=rho[i,k]
+            sx+=rho[i,k]*xx[k]
+            sy+=rho[i,k]*yy[i]
+    if e_tot==0:
+        return 0.,0.,0.,0.,0j,0j
+    center_x=sx/e_tot
+    center_y=sy/e_tot
+    e2_num=0j
+    e3_num=0j
+    e2_den=0.
+    e3_den=0.
+    for i in range(yy.size):
+        y_cen=yy[i]-center_y
+        for k in range(xx.size):
+            if rho[i,k]==0:
+                continue
+            x_cen=xx[k]-center_x
+            z=x_cen+y_cen*1.j
+            r2=x_cen**2+y_cen**2
+            e2_num+=rho[i,k]*z*z
+            e3_num+=rho[i,k]*z*z*z
+            e2_den+=rho[i,k]*r2
+            e3_den+=rho[i,k]*r2**1.5
+    return e_tot,center_x,center_y,np.sqrt(e2_den/e_tot),-e2_num/e2_den,-e3_num/e3_den
+
+#Same observables with no grid-sized temporaries but work (allocated if not
+#given). Every moment of x and y alone is a sum over rows of rho@x^n, and
+#cross moments are products of row sums with powers of y, so only
+#sum(rho*r^3) needs a grid, r^3 written into work. Equal to the 'numpy'
+#method within rounding. For a float32 rho (and work) the products are
+#made in float32 but all the sums are accumulated in float64.
+def _moments_buffered(rho,xx,yy,work=None):
+    if work is None:
+        work=np.empty(rho.shape,dtype=rho.dtype)
+    e_tot=np.sum(rho,dtype=np.float64)
+    if e_tot==0:
+        return 0.,0.,0.,0.,0j,0j
+    rows=np.sum(rho,axis=1,dtype=np.float64)
+    center_x=np.sum(_row_dot(rho,xx,work))/e_tot
+    center_y=np.dot(rows,yy)/e_tot
+    x_cen=xx-center_x
+    y_cen=yy-center_y
+    x1=_row_dot(rho,x_cen,work)
+    x2=_row_dot(rho,x_cen**2,work)
+    sxx=np.sum(x2)
+    syy=np.dot(rows,y_cen**2)
+    sxy=np.dot(x1,y_cen)
+    sxxx=np.sum(_row_dot(rho,x_cen**3,work))
+    sxxy=np.dot(x2,y_cen)
+    sxyy=np.dot(x1,y_cen**2)
+    syyy=np.dot(rows,y_cen**3)
+    np.add.outer(y_cen**2,x_cen**2,out=work)
+    np.power(work,1.5,out=work)
+    if rho.dtype==np.float64:
+        e3_den=np.vdot(work,rho)
+    else:
+        e3_den=np.sum(np.multiply(work,rho,out=work),dtype=np.float64)
+    e2_den=sxx+syy
+    E2=-(sxx-syy+2j*sxy)/e2_den
+    E3=-(sxxx-3*sxyy+1j*(3*sxxy-syyy))/e3_den
+    return e_tot,center_x,center_y,np.sqrt(e2_den/e_tot),E2,E3
+
+#rho@v, in float64. A float32 rho is multiplied into work and summed in float64.
+def _row_dot(rho,v,work):
+    if rho.dtype==np.float64:
+        return rho@v
+    np.multiply(rho,v.astype(rho.dtype),out=work)
+    return np.sum(work,axis=1,dtype=np.float64)
+
+if numba is not None:
+    _moments_jit=numba.njit(cache=True)(_moments_loops)
+else:
+    _moments_jit=_moments_numpy
+
+_moments_methods={'numpy':_moments_numpy,'buffered':_moments_buffered,'jit':_moments_jit}
+
+#work: grid-sized scratch array for the 'buffered' method (e.g. from an
+#EventContext), ignored by the other methods. 'polar' takes E2 and E3 from
+#the PolarMoments engine below.
+def grid_moments(rho,xx,yy,method='numpy',work=None):
+    if method=='buffered':
+        return _moments_buffered(rho,xx,yy,work)
+    if method=='polar':
+        return _polar_23(rho,xx,yy).grid_moments()
+    return _moments_methods[method](rho,xx,yy)
+
+###############################################################
+####     POLAR MOMENTS. eps_n and the event-plane angles    ####
+####     psi_n for any set of harmonics.                    ####
+###############################################################
+
+#Coefficients c[l,k] of x^k y^l in z^n (x^2+y^2)^m, z=x+iy.
+def _polar_poly(n,m):
+    d=n+2*m
+    c=np.zeros((d+1,d+1),dtype=complex)
+    for k in range(n+1):
+        c[n-k,k]=binom(n,k)*1j**(n-k)
+    for _ in range(m):
+        r2=np.zeros_like(c)
+        r2[:,2:]+=c[:,:-2]
+        r2[2:,:]+=c[:-2,:]
+        c=r2
+    return c
+
+#Row i of the result: the coefficients of (t-c)^i in powers of t.
+def _shift_matrix(c,d):
+    i,k=np.indices((d+1,d+1))
+    return np.where(k<=i,binom(i,k)*(-c)**np.maximum(i-k,0),0.)
+
+#Result of PolarMoments: eps and psi in the order of harmonics, eps(n) and
+#psi(n) by harmonic, grid_moments() as returned by grid_moments().
+class Moments(namedtuple('Moments',['e_tot','center_x','center_y','rms','eps','psi','harmonics'])):
+    def eps_n(self,n):
+        return self.eps[self.harmonics.index(n)]
+
+    def psi_n(self,n):
+        return self.psi[self.harmonics.index(n)]
+
+    def grid_moments(self):
+        return self.e_tot,self.center_x,self.center_y,self.rms,self.eps_n(2),self.eps_n(3)
+
+#eps_n=-sum(rho*r^p*exp(i*n*phi))/sum(rho*r^p) around the centroid for the
+#given harmonics, with p=n (radial='rn', as E2 and E3 of the drivers and
+#e_psi_code.C) or p=2 ('r2'), psi_n=(arg(-eps_n)+pi)/n as in e_psi_code.C.
+#eps_1 is 0 by construction with 'rn'.
+#Every sum with a polynomial weight z^n*r^(p-n) (p-n even) is a combination
+#of the moments S[l,k]=sum(rho*x^k*y^l), which are all read in one pass over
+#the grid (rho times the powers of xx, then the powers of yy) and moved to
+#the centroid with binomials, so no complex grid is formed. The powers of
+#the coordinates are passed in (precomputed by EventContext) or computed
+#here. Odd-p denominators (r^3, r^5) and the 'r2' weights of n>2 need a
+#second pass with r and exp(i*phi)=z/r on the grid, powers by products.
+#That pass writes into grid-sized scratch arrays from buffer(name, shape,
+#dtype) (EventContext.buffer, so nothing is allocated in the steady state),
+#or into new arrays without it.
+class PolarMoments(object):
+    def __init__(self,harmonics=(2,3),radial='rn'):
+        self.harmonics=tuple(harmonics)
+        self.radial=radial
+        self.terms=[]
+        self.degree=2 #rms
+        for n in self.harmonics:
+            p=n if radial=='rn' else 2
+            num=_polar_poly(n,(p-n)//2) if p>=n and (p-n)%2==0 else None
+            den=_polar_poly(0,p//2).real if p%2==0 else None
+            self.terms.append((n,p,num,den))
+            self.degree=max([self.degree]+[c.shape[0]-1 for c in (num,den) if c is not None])
+        self.grid_pass=any(num is None or den is None for _,_,num,den in self.terms)
+
+    #Powers 0..degree of the coordinates aa, one per column.
+    def powers(self,aa):
+        return np.vander(aa,self.degree+1,increasing=True)
+
+    def __call__(self,rho,xx,yy,x_pow=None,y_pow=None,buffer=None):
+        nh=len(self.harmonics)
+        x_pow=self.powers(xx) if x_pow is None else x_pow
+        y_pow=self.powers(yy) if y_pow is None else y_pow
+        #The only pass over the grid for the polynomial sums (in float64).
+        S=y_pow.T@np.matmul(rho,x_pow,dtype=np.float64)
+        e_tot=S[0,0]
+        if e_tot==0:
+            return Moments(0.,0.,0.,0.,np.zeros(nh,dtype=complex),np.zeros(nh),self.harmonics)
+        center_x=S[0,1]/e_tot
+        center_y=S[1,0]/e_tot
+        S=_shift_matrix(center_y,self.degree)@S@_shift_matrix(center_x,self.degree).T
+        rms=np.sqrt((S[0,2]+S[2,0])/e_tot)
+        if self.grid_pass:
+            grid=self._grid_sums(rho,xx-center_x,yy-center_y,buffer or _new_array)
+        eps=np.zeros(nh,dtype=complex)
+        psi=np.zeros(nh)
+        for j,(n,p,num,den) in enumerate(self.terms):
+            num=np.sum(num*S[:num.shape[0],:num.shape[1]]) if num is not None else grid[n,p]
+            den=np.sum(den*S[:den.shape[0],:den.shape[1]]) if den is not None else grid[0,p]
+            eps[j]=-num/den
+            psi[j]=(np.arctan2(num.imag,num.real)+np.pi)/n
+        return Moments(e_tot,center_x,center_y,rms,eps,psi,self.harmonics)
+
+    #sum(rho*r^p*exp(i*n*phi)) of the non-polynomial terms, keyed on (n,p).
+    #r^2, r and the odd powers r^p=r*(r^2)^((p-1)/2) are built in place.
+    def _grid_sums(self,rho,x_cen,y_cen,buffer):
+        shape=rho.shape
+        r2=np.add((y_cen**2)[:,None],x_cen**2,out=buffer('polar_r2',shape,np.float64))
+        r=np.sqrt(r2,out=buffer('polar_r',shape,np.float64))
+        t=buffer('polar_t',shape,np.float64)
+        sums={}
+        odd=sorted(set(p for _,p,_,den in self.terms if den is None))
+        if odd:
+            rp=buffer('polar_rp',shape,np.float64)
+            np.copyto(rp,r)
+            q=1
+            for p in odd:
+                for _ in range((p-q)//2):
+                    rp*=r2
+                q=p
+                sums[0,p]=np.sum(np.multiply(rho,rp,out=t))
+        todo=sorted((n,p) for n,p,num,_ in self.terms if num is None)
+        if todo:
+            u=np.add(1j*y_cen[:,None],x_cen,out=buffer('polar_u',shape,complex))
+            np.divide(u,r,out=u,where=r>0) #u=0 at r=0
+            z=buffer('polar_z',shape,complex)
+            for p in set(p for _,p in todo):
+                np.power(r2,p/2,out=t)
+                np.multiply(rho,t,out=z)
+                k=0
+                for n in [n for n,q in todo if q==p]:
+                    for _ in range(n-k):
+                        z*=u
+                    k=n
+                    sums[n,p]=np.sum(z)
+        return sums
+
+#Scratch arrays of PolarMoments without an EventContext.
+def _new_array(name,shape,dtype):
+    return np.empty(shape,dtype=dtype)
+
+#grid_moments(method='polar').
+_polar_23=PolarMoments((2,3))
+
+###############################################################
+####     EVENT CONTEXT. The event grid and the buffers      ####
+####     reused from one event to the next.                 ####
+###############################################################
+
+#Event grid of size x size cells over [-dim, dim]^2 (cell centers xx
+#ascending, yy descending, x_grid, y_grid as in meshgrid) and named buffers
+#that are allocated once and cleared in place for each event. A buffer holds
+#size x size cells; smaller shapes (e.g. a cropped grid) are views on it.
+#allocations counts the buffers allocated so far and event_allocations those
+#of the current event (since new_event()), which is 0 in the steady state.
+#Those only count the buffers of the context. While tracemalloc is tracing,
+#every allocation is measured too: new_event() and end_event() close the
+#previous event and set event_peak, the peak of memory allocated during it
+#(bytes above its start), max_event_peak and mean_event_peak() over the run,
+#and grid_events, the number of events that allocated at least one grid of
+#size x size cells (grids made outside the context, e.g. by a temporary in
+#the event loop). Not everything is a grid: numpy keeps ufunc buffers of
+#~100 kB, the pairwise source tests take O(N_A*N_B) and the block
+#depositions O(block*(2*rad/h)^2) bytes, so on small grids compare the peak
+#with those too.
+#dtype=np.float32 gives the single-precision mode: the buffers, and so the
+#deposition and the products of the observables, are float32 (half the
+#memory traffic), while the coordinates and all sums stay float64.
+class EventContext(object):
+    def __init__(self,dim,size,dtype=np.float64):
+        self.dim=dim
+        self.size=size
+        self.dtype=dtype
+        self.grid_step=2*dim/size #fm
+        self.area=self.grid_step**2 #fm^2
+        xx=np.linspace(-dim,dim,size+1)
+        yy=np.linspace(dim,-dim,size+1)
+        self.xx=(xx[1:]+xx[:-1])/2
+        self.yy=(yy[1:]+yy[:-1])/2
+        self.x_grid,self.y_grid=np.meshgrid(self.xx,self.yy)
+        self.buffers={}
+        self.engines={}
+        self.allocations=0
+        self.event_allocations=0
+        self.event_peak=0
+        self.max_event_peak=0
+        self.sum_event_peak=0
+        self.traced_events=0
+        self.grid_events=0
+        self._traced=None
+
+    def new_event(self):
+        self.end_event()
+        self.event_allocations=0
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            self._traced=tracemalloc.get_traced_memory()[0]
+
+    def mean_event_peak(self):
+        return self.sum_event_peak/max(self.traced_events,1)
+
+    def end_event(self):
+        if self._traced is None or not tracemalloc.is_tracing():
+            return
+        self.event_peak=tracemalloc.get_traced_memory()[1]-self._traced
+        self.max_event_peak=max(self.max_event_peak,self.event_peak)
+        self.sum_event_peak+=self.event_peak
+        self.traced_events+=1
+        if self.event_peak>=self.size**2*np.dtype(self.dtype).itemsize:
+            self.grid_events+=1
+        self._traced=None
+
+    #Buffer name with the given shape (the whole grid by default) and dtype
+    #(that of the context by default), not cleared.
+    def buffer(self,name,shape=None,dtype=None):
+        shape=(self.size,self.size) if shape is None else tuple(shape)
+        dtype=self.dtype if dtype is None else dtype
+        n=int(np.prod(shape))
+        if name not in self.buffers or self.buffers[name].size<n or self.buffers[name].dtype!=dtype:
+            self.buffers[name]=np.empty(max(n,self.size**2),dtype=dtype)
+            self.allocations+=1
+            self.event_allocations+=1
+        return self.buffers[name][:n].reshape(shape)
+
+    #Buffer name cleared in place.
+    def zeros(self,name,shape=None):
+        buf=self.buffer(name,shape)
+        buf.fill(0.)
+        return buf
+
+    #grid_moments with the buffer 'work' as scratch for the 'buffered' method.
+    def moments(self,rho,xx,yy,method='buffered'):
+        return grid_moments(rho,xx,yy,method,self.buffer('work',rho.shape))
+
+    #PolarMoments of rho on the event grid or on a window of it (a cropped
+    #grid), with the powers of xx and yy precomputed once per engine and the
+    #scratch grids of its second pass taken from the buffers.
+    def polar_moments(self,rho,xx,yy,harmonics=(2,3),radial='rn'):
+        key=(tuple(harmonics),radial)
+        if key not in self.engines:
+            engine=PolarMoments(harmonics,radial)
+            self.engines[key]=(engine,engine.powers(self.xx),engine.powers(self.yy))
+        engine,x_pow,y_pow=self.engines[key]
+        k=int(round((xx[0]-self.xx[0])/self.grid_step))
+        i=int(round((self.yy[0]-yy[0])/self.grid_step))
+        if self.xx[k:k+xx.size].size==xx.size and np.array_equal(self.xx[k:k+xx.size],xx) and np.array_equal(self.yy[i:i+yy.size],yy):
+            return engine(rho,xx,yy,x_pow[k:k+xx.size],y_pow[i:i+yy.size],self.buffer)
+        return engine(rho,xx,yy,buffer=self.buffer)
+
+#Accuracy of the single-precision mode against float64 on the same events:
+#add() takes the grid_moments results of both paths for an event. The
+#relative deviations of e_tot and of the rms radius and the absolute
+#deviations of the complex eps_2 and eps_3 are reported by str().
+class PrecisionReport(object):
+    names=('e_tot','rms','eps_2','eps_3')
+
+    def __init__(self):
+        self.dev=[]
+
+    def add(self,low,ref):
+        e,_,_,rms,E2,E3=low
+        e0,_,_,rms0,E20,E30=ref
+        if e0==0:
+            return
+        self.dev.append((abs(e/e0-1),abs(rms/rms0-1),abs(E2-E20),abs(E3-E30)))
+
+    def max(self):
+        return dict(zip(self.names,np.max(self.dev,axis=0))) if self.dev else {}
+
+    def __str__(self):
+        if not self.dev:
+            return 'precision report: no events compared'
+        dev=np.array(self.dev)
+        lines=['precision report over %d events (relative for e_tot and rms, absolute for eps_n):'%len(dev)]
+        for name,d in zip(self.names,dev.T):
+            lines.append('  %-6s max %.2e  mean %.2e'%(name,d.max(),d.mean()))
+        return '\n'.join(lines)
@@ -0,0 +1,134 @@
+from __future__ import division
+import numpy as np
+from magma_tools import EventContext, FFTDeposition, deposit_local, deposit_scatter, deposit_jit, deposit_local_qs, _deposit_loops, overlap_support, overlap_window, grid_moments
+
+rad=1/0.14
+
+#Sources of two nuclei at impact parameter b on the size-100 event grid,
+#some of them near or beyond its edges.
+def two_nuclei(rng,n=60,b=9.):
+    x_A,y_A=rng.normal(-b/2,3.,n),rng.normal(0.,3.,n)
+    x_B,y_B=rng.normal(b/2,3.,n),rng.normal(0.,3.,n)
+    return x_A,y_A,x_B,y_B
+
+#Reference: the per-source loops over the cells of each window.
+def loop_reference(xx,yy,x,y,amp,inv_q2):
+    stack=np.zeros((1,yy.size,xx.size))
+    _deposit_loops(stack,xx,yy,x,y,np.broadcast_to(amp,x.shape)[None],np.broadcast_to(inv_q2,x.shape),rad)
+    return stack[0]
+
+#All backends deposit the same grid as the loops, up to the order of the sums.
+def test_deposit_backends():
+    ctx=EventContext(14,100)
+    rng=np.random.default_rng(1)
+    x=rng.uniform(-8.,8.,80)
+    y=rng.uniform(-8.,8.,80)
+    amp=rng.uniform(0.5,2.,80)
+    inv_q2=rng.uniform(0.1,1.,80)
+    ref=loop_reference(ctx.xx,ctx.yy,x,y,amp,inv_q2)
+    for method in (deposit_local,deposit_scatter,deposit_jit):
+        rho=method(np.zeros_like(ref),ctx.xx,ctx.yy,x,y,amp,inv_q2,rad)
+        np.testing.assert_allclose(rho,ref,rtol=1e-13,atol=0)
+    #Local-Qs with fields constant on the grid.
+    ref=loop_reference(ctx.xx,ctx.yy,x,y,1.5,0.3)
+    rho=deposit_local_qs(np.zeros_like(ref),ctx.xx,ctx.yy,x,y,np.full(ref.shape,1.5),np.full(ref.shape,0.3),rad)
+    np.testing.assert_allclose(rho,ref,rtol=1e-13,atol=0)
+
+#Stacks of grids, and windows of a larger grid (non-contiguous views).
+def test_deposit_stack_and_view():
+    ctx=EventContext(14,100)
+    rng=np.random.default_rng(2)
+    x=rng.uniform(-6.,6.,40)
+    y=rng.uniform(-6.,6.,40)
+    amp=rng.uniform(0.5,2.,(2,40))
+    inv_q2=rng.uniform(0.1,1.,40)
+    rows,cols=slice(10,90),slice(20,70)
+    xx,yy=ctx.xx[cols],ctx.yy[rows]
+    for method in (deposit_local,deposit_scatter,deposit_jit):
+        stack=method(np.zeros((2,yy.size,xx.size)),xx,yy,x,y,amp,inv_q2,rad)
+        for o in range(2):
+            np.testing.assert_allclose(stack[o],loop_reference(xx,yy,x,y,amp[o],inv_q2),rtol=1e-13,atol=0)
+            big=np.zeros((ctx.size,ctx.size))
+            method(big[rows,cols],xx,yy,x,y,amp[o],inv_q2,rad)
+            assert np.array_equal(big[rows,cols],method(np.zeros((yy.size,xx.size)),xx,yy,x,y,amp[o],inv_q2,rad))
+            assert not big[:rows.start].any() and not big[:,:cols.start].any()
+
+#Dropping the sources that pruning rejects leaves rho_A*rho_B unchanged.
+def test_prune_exact():
+    ctx=EventContext(14,100)
+    rng=np.random.default_rng(3)
+    x_A,y_A,x_B,y_B=two_nuclei(rng,b=20.)
+    keep_A,keep_B=overlap_support(x_A,y_A,x_B,y_B,rad)
+    assert not keep_A.all() and not keep_B.all()
+    rho=lambda x,y: deposit_local(np.zeros((ctx.size,ctx.size)),ctx.xx,ctx.yy,x,y,1.,0.3,rad)
+    full=rho(x_A,y_A)*rho(x_B,y_B)
+    pruned=rho(x_A[keep_A],y_A[keep_A])*rho(x_B[keep_B],y_B[keep_B])
+    assert full.any()
+    assert np.array_equal(pruned,full)
+
+#The overlap window holds every non-zero cell of rho_A*rho_B, with the same
+#values, so the moments are those of the full grid.
+def test_crop_exact():
+    ctx=EventContext(14,100)
+    rng=np.random.default_rng(4)
+    x_A,y_A,x_B,y_B=two_nuclei(rng)
+    rows,cols=overlap_window(ctx.xx,ctx.yy,x_A,y_A,x_B,y_B,rad)
+    assert (rows.stop-rows.start)*(cols.stop-cols.start)<ctx.size**2
+    product=lambda xx,yy: (deposit_local(np.zeros((yy.size,xx.size)),xx,yy,x_A,y_A,1.,0.3,rad)*
+                           deposit_local(np.zeros((yy.size,xx.size)),xx,yy,x_B,y_B,1.,0.3,rad))
+    full=product(ctx.xx,ctx.yy)
+    crop=product(ctx.xx[cols],ctx.yy[rows])
+    assert np.array_equal(crop,full[rows,cols])
+    np.testing.assert_allclose(grid_moments(crop,ctx.xx[cols],ctx.yy[rows]),grid_moments(full,ctx.xx,ctx.yy),rtol=1e-13,atol=1e-15)
+    full[rows,cols]=0
+    assert not full.any()
+
+#Cropped windows of the event grid of many shapes share a few kernel spectra,
+#and the store of spectra never grows past max_bytes.
+def test_fft_spectra_bounded():
+    ctx=EventContext(14,100)
+    rng=np.random.default_rng(0)
+    fft=FFTDeposition(1/0.14,0.05,100.,max_bytes=64*2**20)
+    shapes=set()
+    for _ in range(300):
+        i0,k0=rng.integers(0,40,2)
+        ny,nx=rng.integers(20,60,2)
+        xx=ctx.xx[k0:k0+nx]
+        yy=ctx.yy[i0:i0+ny]
+        shapes.add((ny,nx))
+        x=rng.uniform(xx[0],xx[-1],20)
+        y=rng.uniform(yy[-1],yy[0],20)
+        inv_q2=rng.uniform(0.1,1.,20)
+        rho=fft(np.zeros((ny,nx)),xx,yy,x,y,1.,inv_q2,1/0.14)
+        ref=deposit_local(np.zeros((ny,nx)),xx,yy,x,y,1.,inv_q2,1/0.14)
+        assert abs(rho.sum()/ref.sum()-1)<2e-3
+        assert fft.nbytes<=fft.max_bytes
+    assert len(fft.spectra)<len(shapes)
+    assert fft.hits>fft.misses
+
+#On fine grids the cell errors are a few %, and e_tot is off by much less.
+def test_fft_accuracy():
+    ctx=EventContext(14,300)
+    rng=np.random.default_rng(5)
+    fft=FFTDeposition(1/0.14,0.05,100.)
+    for _ in range(10):
+        i0,k0=rng.integers(0,120,2)
+        ny,nx=rng.integers(60,180,2)
+        xx=ctx.xx[k0:k0+nx]
+        yy=ctx.yy[i0:i0+ny]
+        x=rng.uniform(xx[0],xx[-1],20)
+        y=rng.uniform(yy[-1],yy[0],20)
+        inv_q2=rng.uniform(0.1,1.,20)
+        rho=fft(np.zeros((ny,nx)),xx,yy,x,y,1.,inv_q2,1/0.14)
+        ref=deposit_local(np.zeros((ny,nx)),xx,yy,x,y,1.,inv_q2,1/0.14)
+        assert np.abs(rho-ref).max()<0.03*ref.max()
+        assert abs(rho.sum()/ref.sum()-1)<1e-3
+
+#With no room for more, only the last spectra are kept.
+def test_fft_spectra_evicted():
+    ctx=EventContext(14,100)
+    fft=FFTDeposition(1/0.14,0.05,100.,max_bytes=1)
+    for n in (20,40,60,80):
+        rho=fft(np.zeros((n,n)),ctx.xx[:n],ctx.yy[:n],np.zeros(1),np.zeros(1),1.,np.ones(1)*0.5,1/0.14)
+        assert len(fft.spectra)==1
+        assert rho.sum()>0